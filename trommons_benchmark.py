@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2013 Zuza Software Foundation
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Measure how many tasks per minute the importer can handle.
+
+Nothing outside this machine is used: the Pootle API is replaced by a local
+server implementing the bits of the API used by the importer, and the `pootle`
+command is replaced by a stub. Both can be configured to take some time, to
+simulate a real Pootle server. For example:
+
+    python trommons_benchmark.py --tasks 200 --mode thread --workers 8 \\
+        --api-latency 0.02 --command-cost 0.5
+
+The synthetic tasks are written to a temporary directory watched by the same
+directory monitor used by trommons_checker.py.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import os
+import shutil
+import SocketServer
+import stat
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+
+class FakePootleAPI(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the languages, projects and users in the Pootle API.
+
+    It behaves like the tastypie resources used by the importer, with
+    always_return_data enabled.
+    """
+
+    daemon_threads = True
+
+    # Fields used to look for objects of each resource.
+    KEYS = {
+        'languages': 'code',
+        'projects': 'code',
+        'users': 'username',
+    }
+
+    def __init__(self, podirectory, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakePootleHandler)
+        self.podirectory = podirectory
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.objects = dict((resource, []) for resource in self.KEYS)
+        self.request_counts = {}
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/api/v1/" % self.server_port
+
+    def handle_error(self, request, client_address):
+        # Connections kept alive by the importer are cut when the benchmark
+        # finishes, which is fine.
+        pass
+
+    def count(self, method, resource):
+        with self.lock:
+            key = (method, resource)
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    def create(self, resource, data):
+        """Store a new object and return it as the API would."""
+        with self.lock:
+            key = self.KEYS[resource]
+            if any(obj[key] == data[key] for obj in self.objects[resource]):
+                return None
+
+            obj = dict(data)
+            obj['resource_uri'] = "/api/v1/%s/%d/" % (
+                resource, len(self.objects[resource]) + 1)
+            if resource == 'projects':
+                obj['backlink'] = "http://localhost/projects/%s/" % obj['code']
+                # Pootle creates the project directory.
+                os.mkdir(os.path.join(self.podirectory, obj['code']))
+            self.objects[resource].append(obj)
+            return obj
+
+    def create_all(self, resource, objects):
+        """Store all the objects, or none of them if any already exists."""
+        with self.lock:
+            key = self.KEYS[resource]
+            existing = set(obj[key] for obj in self.objects[resource])
+            codes = [data[key] for data in objects]
+            if existing.intersection(codes) or len(set(codes)) != len(codes):
+                return None
+
+        return [self.create(resource, data) for data in objects]
+
+    def find(self, resource, query):
+        """Return the objects matching the tastypie filters in the query."""
+        with self.lock:
+            objects = list(self.objects[resource])
+
+        for name, values in query.items():
+            if name in ('limit', 'offset', 'format'):
+                continue
+            field, lookup = name.split('__')
+            value = values[0]
+            if lookup == 'iexact':
+                objects = [obj for obj in objects
+                           if obj[field].lower() == value.lower()]
+            else:
+                objects = [obj for obj in objects if obj[field] == value]
+        return objects
+
+
+class FakePootleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles the requests for FakePootleAPI."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def parse(self):
+        url = urlparse.urlparse(self.path)
+        resource = url.path.split('/')[3]
+        self.server.count(self.command, resource)
+        time.sleep(self.server.latency)
+        return resource, urlparse.parse_qs(url.query)
+
+    def read_body(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        return json.loads(self.rfile.read(length) or 'null')
+
+    def reply(self, code, data=None):
+        body = json.dumps(data) if data is not None else ""
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        resource, query = self.parse()
+        objects = self.server.find(resource, query)
+
+        limit = int(query.get('limit', ['20'])[0]) or len(objects)
+        offset = int(query.get('offset', ['0'])[0])
+        page = objects[offset:offset + limit]
+        next_page = None
+        if offset + limit < len(objects):
+            next_page = "/api/v1/%s/?limit=%d&offset=%d" % (resource, limit,
+                                                            offset + limit)
+
+        self.reply(200, {
+            'meta': {
+                'limit': limit,
+                'offset': offset,
+                'next': next_page,
+                'total_count': len(objects),
+            },
+            'objects': page,
+        })
+
+    def do_POST(self):
+        resource, query = self.parse()
+        obj = self.server.create(resource, self.read_body())
+        if obj is None:
+            self.reply(400, {'error': "Already exists."})
+        else:
+            self.reply(201, obj)
+
+    def do_PATCH(self):
+        resource, query = self.parse()
+        created = self.server.create_all(resource,
+                                         self.read_body()['objects'])
+        if created is None:
+            self.reply(400, {'error': "Some objects already exist."})
+        else:
+            self.reply(202, {'objects': created})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def install_fake_pootle_command(bin_dir, cost, log_file):
+    """Put a stub `pootle` command first in the PATH.
+
+    The stub logs the management command it was asked to run and then takes
+    cost seconds to finish.
+    """
+    command_path = os.path.join(bin_dir, "pootle")
+    with open(command_path, "w") as command_file:
+        command_file.write('#!/bin/sh\n'
+                           'echo "$1" >> "%s"\n'
+                           'sleep %f\n' % (log_file, cost))
+    os.chmod(command_path, os.stat(command_path).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+
+def fake_management_command(cost, log_file, podirectory, file_size):
+    """Return a stand-in for running management commands inside Pootle.
+
+    Importing translation files takes cost seconds for every file_size bytes
+    in them, and at least cost seconds.
+    """
+    lock = threading.Lock()
+
+    def run_management_command(name, *args):
+        with lock:
+            with open(log_file, "a") as log:
+                log.write(name + "\n")
+
+        factor = 1
+        if name == "update_translation_projects":
+            size = 0
+            for code in args[1::2]:
+                for root, dirs, files in os.walk(os.path.join(podirectory,
+                                                              code)):
+                    size += sum(os.path.getsize(os.path.join(root, filename))
+                                for filename in files)
+            factor = max(1, float(size) / file_size)
+        time.sleep(cost * factor)
+
+    return run_management_command
+
+
+def write_task(pootle_dir, task_id, file_size, languages, users):
+    """Write a synthetic Trommons task like Trommons would."""
+    task_dir = os.path.join(pootle_dir, "task-%d" % task_id)
+    os.mkdir(task_dir)
+
+    target_code = languages[task_id % len(languages)]
+    meta = {
+        'title': u"Benchmark task %d" % task_id,
+        'description': u"Synthetic task written by the benchmark.",
+        'source_code': u"en",
+        'source_name': u"English",
+        'target_code': target_code,
+        'target_name': u"Language %s" % target_code,
+        'assignee_id': u"translator-%d" % (task_id % users),
+        'backlink': u"http://trommons.example.org/task/%d/" % task_id,
+        'translation_filename': u"task.po",
+        'task_id': task_id,
+        'mime': u"po",
+    }
+    with open(os.path.join(task_dir, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+
+    header = ('msgid ""\nmsgstr ""\n'
+              '"Content-Type: text/plain; charset=UTF-8\\n"\n\n')
+    unit = 'msgid "Benchmark unit"\nmsgstr ""\n\n'
+    with open(os.path.join(task_dir, "task.po"), "w") as po_file:
+        po_file.write(header)
+        po_file.write(unit * max(0, (file_size - len(header)) / len(unit)))
+
+    return time.time()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--tasks', type=int, default=100,
+                        help="number of tasks to import")
+    parser.add_argument('--file-size', type=int, default=10000,
+                        help="size in bytes of each translation file")
+    parser.add_argument('--big-every', type=int, default=0,
+                        help="make every given task a big one, with a file "
+                             "100 times bigger, which takes 100 times longer "
+                             "to import with --command inprocess")
+    parser.add_argument('--languages', type=int, default=10,
+                        help="number of different target languages")
+    parser.add_argument('--users', type=int, default=20,
+                        help="number of different translators")
+    parser.add_argument('--api-latency', type=float, default=0.01,
+                        help="seconds taken by each Pootle API request")
+    parser.add_argument('--command-cost', type=float, default=0.2,
+                        help="seconds taken by each management command")
+    parser.add_argument('--command', choices=('subprocess', 'inprocess'),
+                        default='subprocess',
+                        help="run the stub `pootle` command, or simulate "
+                             "running the management commands in process")
+    parser.add_argument('--mode', default='sequential',
+                        choices=('sequential', 'thread', 'process', 'batch'),
+                        help="how the checker imports the tasks")
+    parser.add_argument('--policy', default='smallest',
+                        choices=('none', 'oldest', 'smallest', 'priority'),
+                        help="order in which the waiting tasks are imported")
+    parser.add_argument('--monitor', choices=('inotify', 'polling'),
+                        default='inotify',
+                        help="how the directory monitor notices the tasks")
+    parser.add_argument('--event-loop', action='store_true',
+                        help="watch the changes from an event loop, as the "
+                             "checker does, instead of iterating the monitor")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="number of workers for the thread and process "
+                             "modes")
+    parser.add_argument('--backlog', action='store_true',
+                        help="write the tasks before starting the monitor, "
+                             "as if they arrived while it was down")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="seconds to wait for all the tasks")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    work_dir = tempfile.mkdtemp(prefix="trommons-benchmark-")
+    pootle_dir = os.path.join(work_dir, "pootle")
+    trommons_dir = os.path.join(work_dir, "trommons")
+    podirectory = os.path.join(work_dir, "podirectory")
+    bin_dir = os.path.join(work_dir, "bin")
+    command_log = os.path.join(work_dir, "commands.log")
+    for path in (pootle_dir, trommons_dir, podirectory, bin_dir):
+        os.mkdir(path)
+    open(command_log, "w").close()
+
+    api = FakePootleAPI(podirectory, options.api_latency)
+    api_thread = threading.Thread(target=api.serve_forever)
+    api_thread.daemon = True
+    api_thread.start()
+
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(PODIRECTORY=podirectory)
+
+    import trommons_checker
+    import trommons_script
+    trommons_script.POOTLE_DIR = pootle_dir
+    trommons_script.TROMMONS_DIR = trommons_dir
+    trommons_script.API_URL = api.url
+    trommons_script.WORKER_COUNT = options.workers
+
+    install_fake_pootle_command(bin_dir, options.command_cost, command_log)
+    if options.command == 'inprocess':
+        trommons_script.run_management_command = fake_management_command(
+            options.command_cost, command_log, podirectory, options.file_size)
+
+    languages = [u"lang%d" % i for i in range(options.languages)]
+
+    def file_size(task_id):
+        if options.big_every and task_id % options.big_every == 0:
+            return options.file_size * 100
+        return options.file_size
+
+    created = {}
+    if options.backlog:
+        for task_id in range(options.tasks):
+            created["task-%d" % task_id] = write_task(
+                pootle_dir, task_id, file_size(task_id), languages,
+                options.users)
+
+    start = time.time()
+    trommons_script.warm_up()
+
+    batch = options.mode == 'batch'
+    function = trommons_script.run_batch if batch else trommons_script.run_stuff
+    scheduler = None
+    if options.policy != 'none':
+        scheduler = trommons_checker.Scheduler(trommons_script.describe_task,
+                                               options.policy,
+                                               trommons_script.SCHEDULE_AGING)
+    pool = None
+    if options.mode in ('thread', 'process'):
+        pool = trommons_checker.WorkerPool(
+            function, options.workers, options.mode, 0, scheduler,
+            trommons_script.HEAVY_TASK_SIZE, trommons_script.HEAVY_WORKERS,
+            trommons_script.wait_for_pootle, trommons_script.PootleUnavailable)
+    elif options.mode == 'sequential' and options.event_loop:
+        pool = trommons_checker.WorkerPool(
+            function, 1, 'thread', 0, scheduler,
+            trommons_script.HEAVY_TASK_SIZE, trommons_script.HEAVY_WORKERS,
+            trommons_script.wait_for_pootle, trommons_script.PootleUnavailable)
+
+    monitor = trommons_checker.ChangeMonitor(
+        [pootle_dir], ['task-*'], ['*'], trommons_script.DELAY_BEFORE_RUN,
+        trommons_script.task_is_complete, options.backlog,
+        backend=options.monitor,
+        min_poll_interval=trommons_script.POLL_INTERVAL_MIN,
+        max_poll_interval=trommons_script.POLL_INTERVAL_MAX)
+
+    class QuietReporter(trommons_checker.Reporter):
+        def begin_run(self, change_set):
+            self.run_number += 1
+
+        def end_run(self, ignored_change_set):
+            pass
+
+    runner = trommons_checker.Runner(QuietReporter(), monitor, False, True,
+                                     function, pool, batch, None, scheduler)
+    if options.event_loop:
+        loop = trommons_checker.EventLoop()
+        runner.attach(loop)
+        runner_thread = threading.Thread(target=loop.run_forever)
+    else:
+        runner_thread = threading.Thread(target=runner.main_loop)
+    runner_thread.daemon = True
+    runner_thread.start()
+
+    if not options.backlog:
+        for task_id in range(options.tasks):
+            created["task-%d" % task_id] = write_task(
+                pootle_dir, task_id, file_size(task_id), languages,
+                options.users)
+
+    # A task is done once its notification shows up for Trommons.
+    finished = {}
+    while len(finished) < options.tasks:
+        if time.time() - start > options.timeout:
+            break
+        now = time.time()
+        for name in os.listdir(trommons_dir):
+            # Skip the notifications still being written.
+            if not name.startswith('.'):
+                finished.setdefault(name, now)
+        time.sleep(0.01)
+    elapsed = time.time() - start
+
+    if pool is not None:
+        pool.close()
+    trommons_script.close_api()
+    time.sleep(0.1)
+    api.shutdown()
+    api.server_close()
+
+    latencies = [finished[name] - created[name] for name in finished]
+    with open(command_log) as log:
+        commands = [line.strip() for line in log]
+
+    print "Tasks imported : %d of %d" % (len(finished), options.tasks)
+    print "Elapsed        : %.2fs" % elapsed
+    print "Throughput     : %.1f tasks/minute" % (len(finished) * 60 / elapsed)
+    if latencies:
+        print "Task latency   : p50 %.3fs, p95 %.3fs, p99 %.3fs" % tuple(
+            percentile(latencies, q) for q in (0.5, 0.95, 0.99))
+    print "Runs           : %d" % runner.reporter.run_number
+    print "HTTP requests  : %d" % sum(api.request_counts.values())
+    for (method, resource), count in sorted(api.request_counts.items()):
+        print "    %-6s %-10s %d" % (method, resource, count)
+    print "Commands       : %d" % len(commands)
+    for name in sorted(set(commands)):
+        print "    %-28s %d" % (name, commands.count(name))
+
+    shutil.rmtree(work_dir)
+    return 0 if len(finished) == options.tasks else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,10 +4,58 @@
 given path.
 """
 
-import inotifyx
+import errno
 import fnmatch
+import heapq
+import itertools
+import logging
+import math
+import multiprocessing
+import Queue
+import re
+import select
+import signal
+import threading
 import time
 import os
+from collections import OrderedDict, deque
+
+from trommons_metrics import metrics
+from trommons_profiling import Profiler
+
+try:
+    import inotifyx
+except ImportError:
+    # Only the polling backend can be used.
+    inotifyx = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# When the directory monitor was started, to report how long it takes until
+# it watches for tasks.
+STARTED = time.time()
+
+
+def list_dirs(path):
+    """Return the names, paths and modification times of the dirs in path."""
+
+    if scandir is not None:
+        return [(entry.name, entry.path, entry.stat().st_mtime)
+                for entry in scandir(path) if entry.is_dir()]
+
+    dirs = []
+    for name in os.listdir(path):
+        dir_path = os.path.join(path, name)
+        if os.path.isdir(dir_path):
+            dirs.append((name, dir_path, os.path.getmtime(dir_path)))
+    return dirs
 
 
 class Reporter(object):
@@ -48,87 +96,628 @@ class Reporter(object):
         print
 
 
+class Handle(object):
+    """A callback scheduled in the event loop, which can be cancelled."""
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """Runs callbacks when file descriptors are readable or timers expire.
+
+    This is the small part of an asyncio event loop the monitor needs, which
+    isn't available in Python 2, built on poll(). It must only be used from
+    the thread running it.
+    """
+
+    def __init__(self):
+        self.poller = select.poll()
+        self.readers = {}
+        self.timers = []
+        self.sequence = itertools.count()
+        self.ready = deque()
+
+    def add_reader(self, fd, callback, *args):
+        """Call the callback whenever the file descriptor is readable."""
+
+        self.readers[fd] = Handle(callback, args)
+        self.poller.register(fd, select.POLLIN)
+
+    def call_soon(self, callback, *args):
+        """Call the callback on the next loop iteration."""
+
+        handle = Handle(callback, args)
+        self.ready.append(handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        """Call the callback once the delay in seconds passed."""
+
+        handle = Handle(callback, args)
+        heapq.heappush(self.timers,
+                       (time.time() + delay, next(self.sequence), handle))
+        return handle
+
+    def run_forever(self):
+        """Run the callbacks until interrupted."""
+
+        while True:
+            self.run_once()
+
+    def run_once(self):
+        timeout = 0 if self.ready else None
+        if timeout is None and self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+
+        try:
+            # poll() takes the timeout in milliseconds.
+            events = self.poller.poll(None if timeout is None
+                                      else timeout * 1000)
+        except select.error as e:
+            # Interrupted by a signal, whose handler has already run.
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+
+        handles = list(self.ready)
+        self.ready.clear()
+        for fd, mask in events:
+            if fd in self.readers:
+                handles.append(self.readers[fd])
+
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            handles.append(heapq.heappop(self.timers)[2])
+
+        for handle in handles:
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logging.exception("Error in the event loop callback.")
+
+
+def compile_patterns(patterns):
+    """Return a regular expression matching any of the glob patterns."""
+
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(pattern)
+                               for pattern in patterns) or '(?!)')
+
+
+class DirectoryIndex(object):
+    """Finds the changed directories by polling, for network file systems.
+
+    inotify doesn't see the changes made by other hosts on NFS or CIFS. The
+    inode, modification time and size of the monitored paths and of the white
+    listed dirs directly inside them are kept, so each poll only compares
+    those instead of reading the dirs again. Polls are done more often after
+    a change and less often while nothing changes.
+    """
+
+    def __init__(self, paths, is_white_listed, min_interval, max_interval):
+        self.paths = paths
+        self.is_white_listed = is_white_listed
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+
+        self.roots = {}
+        self.entries = {}
+
+        # The dirs already there are not changes.
+        self.poll()
+
+    def stat(self, path):
+        info = os.stat(path)
+        return (info.st_ino, info.st_mtime, info.st_size)
+
+    def poll(self):
+        """Return the directories changed since the last poll."""
+
+        change_set = set()
+        for root in self.paths:
+            try:
+                key = self.stat(root)
+            except OSError:
+                self.roots.pop(root, None)
+                continue
+
+            # Dirs are only added to or removed from the root when its
+            # modification time changes.
+            if self.roots.get(root) != key:
+                self.roots[root] = key
+                change_set.update(self.list_root(root))
+
+        for path, key in self.entries.items():
+            try:
+                new_key = self.stat(path)
+            except OSError:
+                # The dir was removed.
+                del self.entries[path]
+                continue
+            if new_key != key:
+                self.entries[path] = new_key
+                change_set.add(path)
+
+        if change_set:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+
+        return change_set
+
+    def list_root(self, root):
+        """Update the dirs indexed for the root, returning the new ones."""
+
+        present = set()
+        new = set()
+        for name, path, mtime in list_dirs(root):
+            if not self.is_white_listed(name):
+                continue
+            present.add(path)
+            if path not in self.entries:
+                try:
+                    self.entries[path] = self.stat(path)
+                except OSError:
+                    continue
+                new.add(path)
+
+        for path in self.entries.keys():
+            if os.path.dirname(path) == root and path not in present:
+                del self.entries[path]
+
+        return new
+
+    def wait(self, timeout=None):
+        """Poll until there are changes or timeout seconds passed.
+
+        If timeout is None poll until there are changes.
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            change_set = self.poll()
+            if change_set:
+                return change_set
+
+            wait = self.interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return change_set
+            time.sleep(wait)
+
+
 class ChangeMonitor(object):
-    """Responsible for detecting files being changed."""
+    """Responsible for detecting files being changed.
 
-    def __init__(self, paths, white_list, black_list, delay):
-        """Creates a new file change monitor."""
+    Changes are reported per top level directory inside the monitored paths,
+    once the files in that directory stop changing.
+    """
 
-        # Events of interest.
-        self.WATCH_EVENTS = inotifyx.IN_CREATE | inotifyx.IN_MODIFY | inotifyx.IN_MOVE# | inotifyx.IN_DELETE_SELF | inotifyx.IN_DELETE
+    def __init__(self, paths, white_list, black_list, delay, is_complete=None,
+                 scan_existing=False, backlog_chunk=100, trace_path=None,
+                 backend='inotify', min_poll_interval=0.2,
+                 max_poll_interval=2.0):
+        """Creates a new file change monitor.
+
+        A changed directory is only reported once its files sizes didn't
+        change for the delay period and is_complete, if given, returns true
+        for the directory path and the names of the files inside it.
+
+        If scan_existing is true the directories already present in the
+        paths are reported too, oldest first and in sets of at most
+        backlog_chunk directories.
+
+        If trace_path is given all the inotify events are recorded in that
+        file, so they can be replayed later.
+
+        The backend can be 'inotify' or, for network file systems, 'polling',
+        which polls the paths every min_poll_interval to max_poll_interval
+        seconds. Events are not recorded when polling.
+        """
+
+        if backend not in ('inotify', 'polling'):
+            raise ValueError("Unknown monitor backend '%s'." % backend)
+        if backend == 'inotify' and inotifyx is None:
+            raise ValueError("The inotify backend requires inotifyx.")
 
         # Remember params.
-        self.white_list = white_list
-        self.black_list = black_list
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.white_list = compile_patterns(white_list)
+        self.black_list = compile_patterns(black_list)
         self.delay = delay
+        self.is_complete = is_complete
+        self.backlog_chunk = backlog_chunk
+
+        # Directories that existed before starting, waiting to be reported.
+        self.backlog = OrderedDict()
+
+        # Changed directories waiting for their files to stop changing. Maps
+        # each directory to the snapshot of its files and when it was taken.
+        self.pending = {}
+
+        # When the events were last read, to know what might have been lost
+        # if the kernel event queue overflows.
+        self.last_read = time.time()
+
+        self.watches = {}
+        self.trace = None
+        self.fd = None
+        self.index = None
+        if backend == 'polling':
+            self.index = DirectoryIndex(self.paths, self.is_white_listed,
+                                        min_poll_interval, max_poll_interval)
+        else:
+            self.init_inotify(trace_path)
+
+        # Scan once the watches are in place, so no directory is missed.
+        if scan_existing:
+            self.scan()
+
+    def init_inotify(self, trace_path):
+        """Watch the paths, and the white listed dirs directly inside them."""
+
+        # Events of interest.
+        self.WATCH_EVENTS = (inotifyx.IN_CREATE | inotifyx.IN_CLOSE_WRITE |
+                             inotifyx.IN_MOVED_TO | inotifyx.IN_DELETE_SELF)
+
+        # Record the events, one per line, after a line with the paths. The
+        # files already in each newly watched dir are recorded too, as their
+        # events happened before the dir was watched.
+        if trace_path:
+            self.trace = open(trace_path, 'a')
+            self.trace.write('#paths\t%s\n' % '\t'.join(self.paths))
 
         # Init inotify.
         self.fd = inotifyx.init()
 
         # Watch specified paths.
-        self.watches = {}
-        self.watches.update((inotifyx.add_watch(self.fd, path, self.WATCH_EVENTS), path)
-                            for path in paths)
-
-        # Watch sub dirs of specified paths.  Ensure we modify dirs
-        # variable in place so that os.walk only traverses white
-        # listed dirs.
-        for path in paths:
-            for root, dirs, files in os.walk(path):
-                dirs[:] = [dir for dir in dirs if self.is_white_listed(dir)]
-                self.watches.update((inotifyx.add_watch(self.fd, os.path.join(root, dir), self.WATCH_EVENTS), os.path.join(root, dir))
-                                    for dir in dirs)
+        self.root_watches = set(self.add_watch(path) for path in self.paths)
+        self.root_watches.discard(None)
+
+        # Watch the white listed dirs directly inside the specified paths.
+        # Deeper dirs are not watched since changes are reported per top
+        # level dir.
+        for path in self.paths:
+            for name, dir_path, mtime in list_dirs(path):
+                if self.is_white_listed(name):
+                    self.add_watch(dir_path)
+
+    def scan(self):
+        """Queue the directories already present in the monitored paths.
+
+        Directories whose files are still changing wait like any other
+        changed directory.
+        """
+
+        found = []
+        for root in self.paths:
+            found.extend((mtime, path) for name, path, mtime in list_dirs(root)
+                         if self.is_white_listed(name))
+
+        now = time.time()
+        for mtime, path in sorted(found):
+            if path in self.pending or path in self.backlog:
+                continue
+
+            snapshot = self.snapshot(path)
+            if snapshot is None:
+                continue
+
+            names = [name for name, size in snapshot]
+            if now - self.last_modified(path, names) < self.delay:
+                self.mark_pending(path)
+            elif self.is_complete is None or self.is_complete(path, names):
+                self.backlog[path] = True
+
+    def add_watch(self, path):
+        """Watch the given dir, returning the watch descriptor or None."""
+
+        try:
+            wd = inotifyx.add_watch(self.fd, path, self.WATCH_EVENTS)
+        except (IOError, OSError):
+            # The dir was removed, or there are no more watches available.
+            # Changes in the dir are still detected by polling its files
+            # while it is pending.
+            logging.warning("Couldn't watch '%s'." % path)
+            return None
+
+        self.watches[wd] = path
+        if self.trace is not None and path not in self.paths:
+            self.record_snapshot(path)
+        return wd
+
+    def last_modified(self, path, names):
+        """Return when the directory or any of the files was last modified."""
+
+        try:
+            return max([os.path.getmtime(path)] +
+                       [os.path.getmtime(os.path.join(path, name))
+                        for name in names])
+        except OSError:
+            return time.time()
 
     def monitor_count(self):
         """Return number of paths being monitored."""
 
+        if self.index is not None:
+            return len(self.index.roots) + len(self.index.entries)
         return len(self.watches)
 
     def __iter__(self):
-        """Iterating a monitor returns the next set of changed files.
+        """Iterating a monitor returns the next set of changed directories.
 
         When requesting the next item from a monitor it will block
-        until file changes are detected and then return the set of
-        changed files.
+        until file changes are detected and the changed directories are
+        ready, and then return the sorted list of changed directories.
         """
 
         while True:
-            # Block until events arrive.
-            events = inotifyx.get_events(self.fd)
-
-            # Collect any events that occur within the delay period.
-            # This allows events that occur close to the trigger event
-            # to be collected now rather than causing another run
-            # immediately after this run.
-            if self.delay:
-                time.sleep(self.delay)
-                events.extend(inotifyx.get_events(self.fd, 0))
-
-            # Filter to events that are white listed.
-            events = [event for event in events if self.is_white_listed(event.name)]
-
-            if events:
-                # Track watched dirs.
-                for event in events:
-                    if event.mask & inotifyx.IN_ISDIR and event.mask & inotifyx.IN_CREATE:
-                        self.watches[inotifyx.add_watch(self.fd, os.path.join(self.watches.get(event.wd), event.name), self.WATCH_EVENTS)] = os.path.join(self.watches.get(event.wd), event.name)
-                    elif event.mask & inotifyx.IN_DELETE_SELF:
-                        self.watches.pop(event.wd, None)
+            # Block until events arrive, or until it is time to check
+            # again the directories waiting for their files to settle.
+            # Don't block while there are directories in the backlog.
+            timeout = self.next_timeout()
+            for change in self.wait_for_changes(0 if self.backlog
+                                                else timeout):
+                self.mark_pending(change)
 
+            change_set = self.collect_ready()
+            if change_set:
                 # Supply this set of changes to the caller.
-                change_set = set(os.path.join(self.watches.get(event.wd, ''),
-                                              event.name or '')
-                                 for event in events)
                 yield change_set
 
+            if self.backlog:
+                yield self.next_backlog_chunk()
+
+    def attach(self, loop, callback):
+        """Report the sets of changed directories to callback from the loop.
+
+        This is the alternative to iterating the monitor: the inotify events
+        are read when the loop finds them available, or the paths are polled
+        with a timer, and the directories waiting for their files to settle
+        are checked again with another timer.
+        """
+
+        self.loop = loop
+        self.callback = callback
+        self.timer = None
+        if self.index is None:
+            loop.add_reader(self.fd, self.changes_available)
+        else:
+            loop.call_later(self.index.interval, self.changes_available)
+        loop.call_soon(self.check_pending)
+        loop.call_soon(self.report_backlog)
+
+    def changes_available(self):
+        for change in self.wait_for_changes(0):
+            self.mark_pending(change)
+        self.check_pending()
+
+        if self.index is not None:
+            self.loop.call_later(self.index.interval, self.changes_available)
+
+    def check_pending(self):
+        """Report the settled directories and wait for the rest."""
+
+        change_set = self.collect_ready()
+        if change_set:
+            self.callback(change_set)
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        timeout = self.next_timeout()
+        if timeout is not None:
+            self.timer = self.loop.call_later(timeout, self.check_pending)
+
+    def report_backlog(self):
+        """Report the backlog a chunk at a time, reading events in between."""
+
+        if self.backlog:
+            self.callback(self.next_backlog_chunk())
+        if self.backlog:
+            self.loop.call_soon(self.report_backlog)
+
+    def wait_for_changes(self, timeout=None):
+        """Return the changed dirs, waiting for them up to timeout seconds.
+
+        If timeout is None wait until there are changes.
+        """
+
+        if self.index is not None:
+            return self.index.wait(timeout)
+        return self.handle_events(self.read_events(timeout))
+
+    def read_events(self, timeout=None):
+        """Return the inotify events, waiting for them up to timeout seconds.
+
+        If timeout is None wait until there are events.
+        """
+
+        if timeout is None:
+            events = inotifyx.get_events(self.fd)
+        else:
+            events = inotifyx.get_events(self.fd, timeout)
+
+        if self.trace is not None and events:
+            self.record(events)
+        return events
+
+    def record(self, events):
+        """Write the events to the trace file.
+
+        Each line has the time, watch descriptor, mask, watched path and name
+        for an event, plus the file size for written or moved files, or -1.
+        """
+
+        now = time.time()
+        for event in events:
+            path = self.watches.get(event.wd, '')
+            size = -1
+            if (event.name and not event.mask & inotifyx.IN_ISDIR and
+                event.mask & (inotifyx.IN_CLOSE_WRITE | inotifyx.IN_MOVED_TO)):
+                try:
+                    size = os.path.getsize(os.path.join(path, event.name))
+                except OSError:
+                    pass
+            self.trace.write('%.6f\t%d\t%d\t%s\t%s\t%d\n' %
+                             (now, event.wd, event.mask, path,
+                              event.name or '', size))
+        self.trace.flush()
+
+    def record_snapshot(self, path):
+        """Write the names and sizes of the files in the dir to the trace."""
+
+        snapshot = self.snapshot(path)
+        if snapshot is None:
+            return
+        fields = ['#snapshot', '%.6f' % time.time(), path]
+        for name, size in snapshot:
+            fields.extend([name, str(size)])
+        self.trace.write('\t'.join(fields) + '\n')
+        self.trace.flush()
+
+    def next_backlog_chunk(self):
+        """Remove and return the oldest directories in the backlog."""
+
+        change_set = []
+        while self.backlog and len(change_set) < self.backlog_chunk:
+            change_set.append(self.backlog.popitem(last=False)[0])
+        return change_set
+
+    def next_timeout(self):
+        """Return how long to wait for events, or None to wait forever."""
+
+        if not self.pending:
+            return None
+
+        oldest = min(since for snapshot, since in self.pending.values())
+        return max(0, oldest + self.delay - time.time())
+
+    def handle_events(self, events):
+        """Track watched dirs and return the set of changed directories."""
+
+        change_set = set()
+        overflow = False
+        for event in events:
+            if event.mask & inotifyx.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            path = self.watches.get(event.wd)
+            if path is None:
+                continue
+
+            if event.mask & (inotifyx.IN_IGNORED | inotifyx.IN_DELETE_SELF):
+                # The dir was removed, so its watch is gone.
+                self.watches.pop(event.wd, None)
+                self.root_watches.discard(event.wd)
+                continue
+
+            if event.wd in self.root_watches:
+                if not event.name or not self.is_white_listed(event.name):
+                    continue
+                change = os.path.join(path, event.name)
+                if event.mask & inotifyx.IN_ISDIR:
+                    self.add_watch(change)
+            else:
+                change = path
+            change_set.add(change)
+
+        if overflow:
+            change_set.update(self.rescan(self.last_read))
+        self.last_read = time.time()
+
+        return change_set
+
+    def rescan(self, since):
+        """Return the dirs changed since the given time.
+
+        This is used to recover after the kernel event queue overflows, as
+        the events that didn't fit in it are lost.
+        """
+
+        logging.warning("Too many changes at once, looking for the changed "
+                        "directories.")
+
+        # Forget the watches for removed dirs, since their events might
+        # have been lost too.
+        for wd, path in self.watches.items():
+            if wd not in self.root_watches and not os.path.isdir(path):
+                del self.watches[wd]
+
+        watched = set(self.watches.values())
+        change_set = set()
+        for root in self.paths:
+            for name, path, mtime in list_dirs(root):
+                if not self.is_white_listed(name):
+                    continue
+                if path not in watched:
+                    self.add_watch(path)
+
+                snapshot = self.snapshot(path)
+                if snapshot is None:
+                    continue
+                names = [file_name for file_name, size in snapshot]
+                if self.last_modified(path, names) >= since - self.delay:
+                    change_set.add(path)
+
+        return change_set
+
+    def mark_pending(self, change):
+        """Wait for the files in the changed directory to settle."""
+
+        self.backlog.pop(change, None)
+        self.pending[change] = (None, time.time())
+
+    def collect_ready(self):
+        """Return the pending directories whose files settled."""
+
+        change_set = []
+        now = time.time()
+        for change, (previous, since) in self.pending.items():
+            snapshot = self.snapshot(change)
+            if snapshot is None:
+                # The directory was removed.
+                del self.pending[change]
+            elif snapshot != previous:
+                self.pending[change] = (snapshot, now)
+            elif now - since >= self.delay:
+                del self.pending[change]
+                names = [name for name, size in snapshot]
+                if self.is_complete is None or self.is_complete(change, names):
+                    change_set.append(change)
+                # Otherwise wait for the next change in the directory.
+
+        return sorted(change_set)
+
+    def snapshot(self, path):
+        """Return the names and sizes of the files in the directory.
+
+        None is returned if the directory can't be read.
+        """
+
+        try:
+            return tuple(sorted((name, os.path.getsize(os.path.join(path, name)))
+                                for name in os.listdir(path)))
+        except OSError:
+            return None
+
     def clear(self):
-        """Clears and returns any changed files that are waiting in the
+        """Clears and returns any changed directories that are waiting in the
         queue."""
 
-        events = inotifyx.get_events(self.fd, 0)
-        change_set = set(os.path.join(self.watches.get(event.wd, ''),
-                                      event.name or '')
-                         for event in events if self.is_white_listed(event.name))
+        change_set = self.wait_for_changes(0)
+        for change in change_set:
+            self.pending.pop(change, None)
         return change_set
 
     def is_white_listed(self, name):
@@ -140,38 +729,342 @@ class ChangeMonitor(object):
             return True
 
         # Names in white list are always considered in.
-        for pattern in self.white_list:
-            if fnmatch.fnmatch(name, pattern):
-                return True
+        if self.white_list.match(name):
+            return True
 
         # Names in black list are always considered out.
-        for pattern in self.black_list:
-            if fnmatch.fnmatch(name, pattern):
-                return False
+        if self.black_list.match(name):
+            return False
 
         # If not white or black listed then considered in.
         return True
 
 
+def ignore_interrupts():
+    """Leave handling keyboard interrupts to the parent process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class Scheduler(object):
+    """Decides in which order the waiting paths are run.
+
+    The describe function returns the size, priority and arrival time of a
+    path. Depending on the policy the oldest, the smallest or the highest
+    priority paths are run first. With aging, a path moves ahead as if it were
+    half the size, or one priority higher, for every aging seconds it waits, so
+    big paths are not left waiting forever.
+    """
+
+    POLICIES = ('oldest', 'smallest', 'priority')
+
+    def __init__(self, describe, policy='oldest', aging=None):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown schedule policy '%s'." % policy)
+
+        self.describe = describe
+        self.policy = policy
+        self.aging = aging
+
+    def rank(self, info, now):
+        """Return the rank of a path, the lowest ranked paths run first."""
+
+        size, priority, arrived = info
+        if self.policy == 'oldest':
+            return (arrived,)
+
+        boost = (now - arrived) / self.aging if self.aging else 0
+        size_class = math.log(size + 1, 2)
+        if self.policy == 'smallest':
+            return (size_class - boost, arrived)
+        return (-priority - boost, size_class, arrived)
+
+    def order(self, paths):
+        """Return the paths in the order they should be run."""
+
+        now = time.time()
+        infos = dict((path, self.describe(path)) for path in paths)
+        return sorted(paths, key=lambda path: self.rank(infos[path], now))
+
+
+class ScheduledQueue(object):
+    """Queue of paths for the worker pool, handing out the best path first.
+
+    Paths of at least heavy_size are heavy, and no more than heavy_limit of
+    them are handed out at once so the rest of the workers are kept for the
+    light paths. Without a scheduler the paths are handed out in order.
+    """
+
+    def __init__(self, scheduler=None, maxsize=0, heavy_size=None,
+                 heavy_limit=None):
+        self.scheduler = scheduler
+        self.maxsize = maxsize
+        self.heavy_size = heavy_size
+        self.heavy_limit = heavy_limit
+
+        self.condition = threading.Condition()
+        self.items = OrderedDict()
+        self.heavy_running = 0
+        self.closed = False
+
+    def qsize(self):
+        with self.condition:
+            return len(self.items)
+
+    def is_heavy(self, info):
+        return (self.heavy_size is not None and info is not None and
+                info[0] >= self.heavy_size)
+
+    def put(self, path, timeout=None):
+        """Add the path, raising Queue.Full if there is no room in time."""
+
+        info = None
+        if self.scheduler is not None:
+            info = self.scheduler.describe(path)
+
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while self.maxsize and len(self.items) >= self.maxsize:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise Queue.Full
+                self.condition.wait(remaining)
+            self.items[path] = info
+            self.condition.notify_all()
+
+    def pick(self):
+        """Return the best path that can be handed out now, or None."""
+
+        heavy_allowed = (self.heavy_limit is None or
+                         self.heavy_running < self.heavy_limit)
+        eligible = [path for path, info in self.items.items()
+                    if heavy_allowed or not self.is_heavy(info)]
+        if not eligible:
+            return None
+        if self.scheduler is None:
+            return eligible[0]
+
+        now = time.time()
+        return min(eligible,
+                   key=lambda path: self.scheduler.rank(self.items[path], now))
+
+    def get(self):
+        """Return the next path and whether it is heavy.
+
+        This blocks until there is a path that can be handed out. Once closed,
+        (None, False) is returned when the queue is empty.
+        """
+
+        with self.condition:
+            while True:
+                path = self.pick()
+                if path is not None:
+                    heavy = self.is_heavy(self.items.pop(path))
+                    if heavy:
+                        self.heavy_running += 1
+                    self.condition.notify_all()
+                    return path, heavy
+                if self.closed and not self.items:
+                    return None, False
+                self.condition.wait()
+
+    def task_done(self, heavy):
+        """Tell that a handed out path finished running."""
+
+        if heavy:
+            with self.condition:
+                self.heavy_running -= 1
+                self.condition.notify_all()
+
+    def close(self):
+        """Make the workers stop once the queue is empty."""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class WorkerPool(object):
+    """Responsible for running the function on several paths at once."""
+
+    def __init__(self, function, size, mode='thread', queue_size=0,
+                 scheduler=None, heavy_size=None, heavy_workers=1, gate=None,
+                 retry_on=()):
+        """Creates a new pool of workers.
+
+        The mode can be 'thread' to run the function in the worker threads, or
+        'process' to have each worker thread hand the function over to a pool
+        of processes. If a scheduler is given the waiting paths are run in the
+        order it decides, and if heavy_size is given no more than
+        heavy_workers of the workers run heavy paths at once. If gate is given
+        each worker calls it before running a path, and paths failing with one
+        of the retry_on exceptions are run again once the gate lets them.
+        """
+
+        if mode not in ('thread', 'process'):
+            raise ValueError("Unknown worker mode '%s'." % mode)
+
+        self.function = function
+        self.gate = gate
+        self.retry_on = retry_on
+        heavy_limit = None
+        if heavy_size is not None and scheduler is not None:
+            heavy_limit = max(1, heavy_workers)
+        else:
+            heavy_size = None
+        self.queue = ScheduledQueue(scheduler, queue_size, heavy_size,
+                                    heavy_limit)
+
+        # Paths waiting in the queue, paths being run and paths that changed
+        # again while being run. A path is never run by two workers at once.
+        self.lock = threading.Lock()
+        self.queued = set()
+        self.in_flight = set()
+        self.rerun = set()
+
+        self.process_pool = None
+        if mode == 'process':
+            self.process_pool = multiprocessing.Pool(size, ignore_interrupts)
+
+        metrics.gauge('queue_depth', self.queue.qsize)
+        metrics.gauge('tasks_in_flight', lambda: len(self.in_flight))
+
+        self.threads = [threading.Thread(target=self.work)
+                        for i in range(size)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, path):
+        """Queue the path to be run, blocking while the queue is full."""
+
+        with self.lock:
+            if path in self.queued:
+                return
+            if path in self.in_flight:
+                # Run it again once the current run finishes.
+                self.rerun.add(path)
+                return
+            self.queued.add(path)
+
+        # Use a timeout so keyboard interrupts are not delayed until there is
+        # room in the queue.
+        while True:
+            try:
+                self.queue.put(path, timeout=0.5)
+                break
+            except Queue.Full:
+                continue
+
+    def work(self):
+        """Run queued paths until told to stop."""
+
+        while True:
+            path, heavy = self.queue.get()
+            if path is None:
+                break
+
+            with self.lock:
+                self.queued.discard(path)
+                self.in_flight.add(path)
+
+            while True:
+                if self.gate is not None:
+                    self.gate()
+                if self.call(path):
+                    continue
+                with self.lock:
+                    if path not in self.rerun:
+                        self.in_flight.discard(path)
+                        break
+                    self.rerun.discard(path)
+
+            self.queue.task_done(heavy)
+
+    def call(self, path):
+        """Run the function on the given path.
+
+        Returns whether it has to be run again.
+        """
+
+        try:
+            if self.process_pool is not None:
+                result = self.process_pool.apply(self.function, (path,))
+                # The metrics recorded in the worker processes are lost, so
+                # at least count the results here.
+                if result is not None:
+                    metrics.inc('tasks_total',
+                                result='success' if result else 'failure')
+            else:
+                self.function(path)
+        except self.retry_on as e:
+            logging.warning("Running '%s' was put off: %s" % (path, e))
+            return True
+        except Exception:
+            logging.exception("Running '%s' failed." % path)
+        return False
+
+    def close(self):
+        """Stop accepting paths and wait for the queued ones to finish.
+
+        Another keyboard interrupt while waiting abandons the queued paths.
+        """
+
+        try:
+            self.queue.close()
+            for thread in self.threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            pass
+
+        if self.process_pool is not None:
+            self.process_pool.terminate()
+            self.process_pool.join()
+
+
 class Runner(object):
     """Responsible for running a specified command upon file changes."""
 
     def __init__(self, reporter, change_monitor, ignore_events, no_initial_run,
-                 function):
-        """Creates a new command runner."""
+                 function, pool=None, batch=False, gate=None, scheduler=None):
+        """Creates a new command runner.
+
+        If a worker pool is given the changes are handed over to it instead of
+        running the function on them one after the other. If batch is true the
+        function is run once with the whole change set. If gate is given it
+        is called before each run, to block the run while it isn't possible.
+        If a scheduler is given the changes run one after the other are run in
+        the order it decides.
+        """
 
         self.reporter = reporter
         self.change_monitor = change_monitor
         self.ignore_events = ignore_events
         self.no_initial_run = no_initial_run
         self.function = function
+        self.pool = pool
+        self.batch = batch
+        self.gate = gate
+        self.scheduler = scheduler
 
     def do_run(self, change_set):
         """Perform a command run."""
 
+        if self.gate is not None:
+            self.gate()
+
         self.reporter.begin_run(change_set)
-        for change in change_set:
-            self.function(change)
+        if self.batch:
+            if change_set:
+                self.function(change_set)
+        elif self.pool is not None:
+            for change in change_set:
+                self.pool.submit(change)
+        else:
+            if self.scheduler is not None:
+                change_set = self.scheduler.order(change_set)
+            for change in change_set:
+                self.function(change)
         ignored_change_set = self.change_monitor.clear() if self.ignore_events else set()
         self.reporter.end_run(ignored_change_set)
 
@@ -189,6 +1082,22 @@ class Runner(object):
         for change_set in self.change_monitor:
             self.do_run(change_set)
 
+    def attach(self, loop):
+        """Do the runs from the event loop as the monitor reports changes.
+
+        This is the alternative to main_loop. Using a worker pool the loop
+        keeps reading the changes while the function runs.
+        """
+
+        # Report number of paths being monitored.
+        self.reporter.monitor_count(self.change_monitor.monitor_count())
+
+        # Do initial function run.
+        if not self.no_initial_run:
+            loop.call_soon(self.do_run, set())
+
+        self.change_monitor.attach(loop, self.do_run)
+
 
 #def test_function(change):
 #    """Simple tester, put our real function in here"""
@@ -198,17 +1107,44 @@ class Runner(object):
 def main():
     """Setup and enter main loop."""
 
-    from trommons_script import run_stuff, DELAY_BEFORE_RUN, POOTLE_DIR
+    # Set the default logging level to INFO, which makes easier to check that
+    # everything works as expected. This must be done before anything logs.
+    logging.basicConfig(level=logging.INFO)
+
+    from trommons_script import (run_stuff, run_batch, warm_up, log_api_stats,
+                                 task_is_complete, wait_for_pootle,
+                                 PootleUnavailable,
+                                 interrupted_tasks, describe_task,
+                                 start_exporting_translations,
+                                 DELAY_BEFORE_RUN, POOTLE_DIR, BATCH_IMPORT,
+                                 WORKER_MODE, WORKER_COUNT, WORKER_QUEUE_SIZE,
+                                 METRICS_FILE, METRICS_PORT, METRICS_INTERVAL,
+                                 EVENT_TRACE_FILE, SCHEDULE_POLICY,
+                                 SCHEDULE_AGING, HEAVY_TASK_SIZE,
+                                 HEAVY_WORKERS, MONITOR_BACKEND,
+                                 POLL_INTERVAL_MIN, POLL_INTERVAL_MAX,
+                                 EXPORT_INTERVAL, INSTANCE_INDEX,
+                                 PROFILE_DIR, PROFILE_EVERY)
 
     #: function to execute when files change
     function = run_stuff  #was test_function
+    #: run the function once for every set of changed files
+    batch = BATCH_IMPORT
+    if batch:
+        function = run_batch
+    #: profile the imports when asked to with signals, or every few imports
+    profiler = Profiler(PROFILE_DIR, PROFILE_EVERY)
+    if WORKER_MODE != 'process':
+        function = profiler.wrap(function)
+    signal.signal(signal.SIGUSR1, profiler.toggle)
+    signal.signal(signal.SIGUSR2, profiler.snapshot_memory)
 
     #: paths to monitor
     paths = [POOTLE_DIR]
 
 
-    #: how long to wait for additional events after a function run is
-    #: triggered
+    #: how long the files in a changed directory must stay the same before
+    #: the function is run for it
     delay = DELAY_BEFORE_RUN
     #: whether to ignore events that occur during the command run
     ignore_events = False
@@ -221,24 +1157,102 @@ def main():
     #: don't perform an initial run of the command, instead start
     #: monitoring and wait for changes
     no_initial_run = True
+    #: import the tasks that arrived while the monitor wasn't running
+    scan_existing = True
+
+    # Watch for changes before anything else, so no task arriving while
+    # starting is missed. The changes wait until the event loop reads them.
+    change_monitor = ChangeMonitor(paths, white_list, black_list, delay,
+                                   task_is_complete, scan_existing,
+                                   trace_path=EVENT_TRACE_FILE,
+                                   backend=MONITOR_BACKEND,
+                                   min_poll_interval=POLL_INTERVAL_MIN,
+                                   max_poll_interval=POLL_INTERVAL_MAX)
+    metrics.gauge('startup_seconds', time.time() - STARTED)
+
+    #: decide the order in which the waiting tasks are imported
+    scheduler = None
+    if SCHEDULE_POLICY:
+        scheduler = Scheduler(describe_task, SCHEDULE_POLICY, SCHEDULE_AGING)
+
+    # The runs wait until the warm-up below finishes.
+    warmed_up = threading.Event()
+
+    def gate():
+        # Use a timeout so keyboard interrupts are not delayed.
+        while not warmed_up.wait(0.5):
+            pass
+        wait_for_pootle()
+
+    #: import several tasks at once using a pool of workers, or one after
+    #: the other using a single worker so changes are watched meanwhile. The
+    #: tasks put off while Pootle is not available are imported again later.
+    #: The worker processes are forked before starting any other thread, so
+    #: they don't inherit locks held by those threads.
+    pool = None
+    if not batch:
+        pool = WorkerPool(function, WORKER_COUNT if WORKER_MODE else 1,
+                          WORKER_MODE or 'thread', WORKER_QUEUE_SIZE,
+                          scheduler, HEAVY_TASK_SIZE, HEAVY_WORKERS, gate,
+                          PootleUnavailable)
+
+    # Expose the timings of the import stages and other metrics.
+    metrics.start_exporting(METRICS_FILE, METRICS_PORT, METRICS_INTERVAL)
+
+    # Hand the translated files back to Trommons as they change.
+    if EXPORT_INTERVAL and INSTANCE_INDEX == 0:
+        start_exporting_translations(EXPORT_INTERVAL)
+
+    # Retrieve the data that is reused by all the imports, like the existing
+    # languages, in the background. The runs wait for it, and if Pootle is
+    # not available now the data is retrieved when importing the first task.
+    def warm_up_in_background():
+        start = time.time()
+        try:
+            warm_up()
+        except Exception:
+            logging.exception("Couldn't retrieve the data from Pootle.")
+        finally:
+            metrics.gauge('warm_up_seconds', time.time() - start)
+            warmed_up.set()
+
+    warm_up_thread = threading.Thread(target=warm_up_in_background)
+    warm_up_thread.daemon = True
+    warm_up_thread.start()
 
     try:
         # Create the reporter that prints info to the terminal.
         with Reporter() as reporter:
 
-            # Create the monitor that watches for file changes.
-            change_monitor = ChangeMonitor(paths, white_list, black_list,
-                                           delay)
-
             # Create the runner that invokes the function on file changes.
             runner = Runner(reporter, change_monitor, ignore_events,
-                            no_initial_run, function)
+                            no_initial_run, function, pool, batch, gate,
+                            scheduler)
+
+            # Resume the imports interrupted when the daemon stopped, some of
+            # which no longer have a task directory to be noticed.
+            interrupted = interrupted_tasks()
+            if interrupted:
+                logging.info("Resuming %d interrupted imports." %
+                             len(interrupted))
+                for path in interrupted:
+                    change_monitor.backlog.pop(path, None)
+                runner.do_run(interrupted)
 
-            # Enter the main loop until we break out.
-            runner.main_loop()
+            # Run the event loop until we break out.
+            loop = EventLoop()
+            runner.attach(loop)
+            loop.run_forever()
 
     except KeyboardInterrupt:
         pass
+    finally:
+        # Let the workers finish the tasks already handed over to them.
+        if pool is not None:
+            pool.close()
+
+        # Show how long the Pootle API took to answer the requests.
+        log_api_stats()
 
 
 if __name__ == '__main__':
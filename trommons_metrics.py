@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2013 Zuza Software Foundation
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Timings and counters for the importer, in the Prometheus text format.
+
+The metrics can be written periodically to a file, to be collected by the
+Prometheus node exporter, and/or served over HTTP in the /metrics path.
+"""
+
+import BaseHTTPServer
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+# Use a monotonic clock if there is one, so timings are not affected by
+# changes to the system clock.
+clock = getattr(time, 'monotonic', time.time)
+
+# Prefix for the name of all the metrics.
+PREFIX = "trommons_"
+
+# Quantiles reported for the timings.
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Summary(object):
+    """Durations of something, keeping the most recent ones for quantiles."""
+
+    def __init__(self, size=1000):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=size)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def quantile(self, q):
+        """Return the q quantile of the recent values."""
+        values = sorted(self.recent)
+        if not values:
+            return float('nan')
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def format_labels(labels):
+    """Return the labels in the Prometheus text format."""
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, value)
+                             for key, value in labels)
+
+
+class Metrics(object):
+    """Registry for all the timings, counters and gauges."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.summaries = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value, **labels):
+        """Record a duration in seconds."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.summaries:
+                self.summaries[key] = Summary()
+            self.summaries[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Record how long the wrapped block takes, even if it fails."""
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(name, clock() - start, **labels)
+
+    def timed(self, stage):
+        """Decorator recording the duration of each call as an import stage."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer('stage_seconds', stage=stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def inc(self, name, amount=1, **labels):
+        """Increase a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        """Set a gauge to a value, or to a function returning the value."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def render(self):
+        """Return all the metrics in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            summaries = sorted(self.summaries.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+
+        for (name, labels), summary in summaries:
+            for q in QUANTILES:
+                lines.append("%s%s%s %r" %
+                             (PREFIX, name,
+                              format_labels(labels + (('quantile', q),)),
+                              summary.quantile(q)))
+            lines.append("%s%s_sum%s %r" % (PREFIX, name,
+                                            format_labels(labels),
+                                            summary.total))
+            lines.append("%s%s_count%s %d" % (PREFIX, name,
+                                              format_labels(labels),
+                                              summary.count))
+
+        for (name, labels), value in counters:
+            lines.append("%s%s%s %r" % (PREFIX, name, format_labels(labels),
+                                        value))
+
+        for (name, labels), value in gauges:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    logging.exception("Couldn't get the value for the '%s' "
+                                      "gauge." % name)
+                    continue
+            lines.append("%s%s%s %r" % (PREFIX, name, format_labels(labels),
+                                        value))
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the metrics to the file, replacing it atomically."""
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp_path, "w") as output_file:
+            output_file.write(self.render())
+        os.rename(temp_path, path)
+
+    def start_exporting(self, textfile=None, port=None, interval=15):
+        """Expose the metrics in the background.
+
+        The metrics are written to textfile every interval seconds and/or
+        served on the given port of localhost.
+        """
+        if textfile:
+            def write_periodically():
+                while True:
+                    try:
+                        self.write_textfile(textfile)
+                    except (IOError, OSError):
+                        logging.exception("Couldn't write the metrics file.")
+                    time.sleep(interval)
+
+            thread = threading.Thread(target=write_periodically)
+            thread.daemon = True
+            thread.start()
+
+        if port:
+            registry = self
+
+            class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = registry.render()
+                    self.send_response(200)
+                    self.send_header('Content-Type',
+                                     'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            server = BaseHTTPServer.HTTPServer(('127.0.0.1', port),
+                                               MetricsHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+
+#: metrics shared by the whole importer
+metrics = Metrics()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2013 Zuza Software Foundation
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Profiling of the running importer, started and stopped with signals.
+
+While profiling, every import is run under cProfile and the stacks of all the
+threads are sampled. When profiling stops the merged pstats file and the
+sampled stacks, in the collapsed format used by flame graph tools, are
+written. Memory snapshots show what was allocated since the previous one.
+"""
+
+import cProfile
+import gc
+import itertools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+try:
+    import tracemalloc
+except ImportError:
+    # Not available before Python 3.4, so objects are counted instead.
+    tracemalloc = None
+
+
+class Profiler(object):
+    """Profiles the imports on demand, or every few imports."""
+
+    def __init__(self, directory, every=None, sample_interval=0.01):
+        self.directory = directory
+        self.every = every
+        self.sample_interval = sample_interval
+
+        self.lock = threading.Lock()
+        self.active = False
+        self.generation = 0
+        self.runs = 0
+        self.stats = None
+        self.stacks = Counter()
+        self.previous_memory = None
+        self.sequence = itertools.count(1)
+
+    def wrap(self, function):
+        """Return the function, profiled when profiling."""
+        def profiled(*args):
+            return self.call(function, *args)
+        return profiled
+
+    def call(self, function, *args):
+        with self.lock:
+            self.runs += 1
+            every_nth = bool(self.every) and self.runs % self.every == 0
+            if not (self.active or every_nth):
+                profile = None
+            else:
+                profile = cProfile.Profile()
+
+        if profile is None:
+            return function(*args)
+
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            with self.lock:
+                if self.active:
+                    # Merge it with the rest, until profiling stops.
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+                    profile = None
+            if profile is not None:
+                self.write_profile(pstats.Stats(profile), Counter())
+
+    def toggle(self, signum=None, frame=None):
+        """Start or stop profiling, writing the profile when stopping.
+
+        This is meant to be used as a signal handler, so the work is done in
+        another thread.
+        """
+        thread = threading.Thread(target=self.switch)
+        thread.daemon = True
+        thread.start()
+
+    def switch(self):
+        with self.lock:
+            self.active = not self.active
+            self.generation += 1
+            active = self.active
+            generation = self.generation
+            stats, self.stats = self.stats, None
+            stacks, self.stacks = self.stacks, Counter()
+
+        if active:
+            logging.info("Profiling the imports.")
+            sampler = threading.Thread(target=self.sample, args=(generation,))
+            sampler.daemon = True
+            sampler.start()
+        else:
+            self.write_profile(stats, stacks)
+
+    def sample(self, generation):
+        """Count the stacks of the other threads while profiling."""
+        me = threading.current_thread().ident
+        while self.generation == generation:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name,
+                                                 os.path.basename(
+                                                     code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                with self.lock:
+                    self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.sample_interval)
+
+    def output_path(self, kind, extension):
+        return os.path.join(self.directory, "%s-%s-%d-%d.%s" % (
+            kind, time.strftime("%Y%m%d-%H%M%S"), os.getpid(),
+            next(self.sequence), extension))
+
+    def write_profile(self, stats, stacks):
+        """Write the pstats file and the collapsed stacks, if any."""
+        try:
+            if stats is not None:
+                path = self.output_path("profile", "pstats")
+                stats.dump_stats(path)
+                logging.info("Wrote the profile to '%s'." % path)
+            if stacks:
+                path = self.output_path("profile", "collapsed")
+                with open(path, "w") as stacks_file:
+                    for stack, count in sorted(stacks.items()):
+                        stacks_file.write("%s %d\n" % (stack, count))
+                logging.info("Wrote the sampled stacks to '%s'." % path)
+            if stats is None and not stacks:
+                logging.info("Nothing was imported while profiling.")
+        except (IOError, OSError):
+            logging.exception("Couldn't write the profile.")
+
+    def snapshot_memory(self, signum=None, frame=None):
+        """Write what was allocated since the previous snapshot.
+
+        This is meant to be used as a signal handler, so the work is done in
+        another thread.
+        """
+        thread = threading.Thread(target=self.write_memory)
+        thread.daemon = True
+        thread.start()
+
+    def write_memory(self):
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                self.previous_memory = tracemalloc.take_snapshot()
+                logging.info("Tracing the memory allocations.")
+                return
+            current = tracemalloc.take_snapshot()
+            lines = [str(difference) for difference in
+                     current.compare_to(self.previous_memory, 'lineno')[:50]]
+        else:
+            gc.collect()
+            current = Counter(type(obj).__name__ for obj in gc.get_objects())
+            previous = self.previous_memory or Counter()
+            differences = sorted(((count - previous[name], count, name)
+                                  for name, count in current.items()),
+                                 reverse=True)[:50]
+            lines = ["%s: %d objects (%+d)" % (name, count, difference)
+                     for difference, count, name in differences]
+        self.previous_memory = current
+
+        path = self.output_path("memory", "txt")
+        try:
+            with open(path, "w") as memory_file:
+                memory_file.write("\n".join(lines) + "\n")
+        except (IOError, OSError):
+            logging.exception("Couldn't write the memory snapshot.")
+            return
+        logging.info("Wrote the memory snapshot to '%s'." % path)
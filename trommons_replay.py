@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2013 Zuza Software Foundation
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Replay file system events recorded by the directory monitor.
+
+Set EVENT_TRACE_FILE in trommons_script.py to record the events seen by
+trommons_checker.py. This script then redoes the recorded changes in a scratch
+directory, at the original pace or faster, while the directory monitor watches
+it, and reports how well the monitor grouped the events. For example:
+
+    python trommons_replay.py events.trace --speed 10 --delay 0.5
+
+No task is imported: the runs are only recorded.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import inotifyx
+
+from trommons_checker import ChangeMonitor, Reporter, Runner
+
+
+class ReplayReporter(Reporter):
+    """Doesn't display anything, the report is shown at the end."""
+
+    def begin_run(self, change_set):
+        self.run_number += 1
+
+    def end_run(self, ignored_change_set):
+        pass
+
+    def __exit__(self, e_type, e_value, tb):
+        pass
+
+
+def read_trace(trace_path):
+    """Return the recorded paths and events in the trace file.
+
+    Each event is a (time, mask, path, size, files) tuple, with path relative
+    to the recorded path it belongs to. Snapshots of the files already in a
+    newly watched dir have a mask of 0 and the list of (name, size) files.
+    """
+    roots = []
+    events = []
+
+    with open(trace_path) as trace:
+        for line in trace:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == '#paths':
+                roots = sorted(fields[1:], key=len, reverse=True)
+                continue
+
+            files = None
+            if fields[0] == '#snapshot':
+                timestamp, path = fields[1:3]
+                mask = size = 0
+                files = zip(fields[3::2],
+                            [int(file_size) for file_size in fields[4::2]])
+            else:
+                timestamp, wd, mask, watched, name, size = fields
+                path = os.path.join(watched, name) if name else watched
+            for root in roots:
+                if path == root or path.startswith(root + os.sep):
+                    path = os.path.relpath(path, root)
+                    break
+            else:
+                continue
+            events.append((float(timestamp), int(mask), path, int(size),
+                           files))
+
+    return events
+
+
+def create_file(scratch_dir, full_path, size):
+    """Create the file with the given size by moving it in place."""
+    temp_path = os.path.join(scratch_dir, '.replay-move')
+    with open(temp_path, 'w') as temp_file:
+        temp_file.truncate(max(size, 0))
+    os.rename(temp_path, full_path)
+
+
+def apply_event(scratch_dir, mask, path, size, files=None):
+    """Redo in the scratch directory the change that caused the event."""
+    full_path = os.path.normpath(os.path.join(scratch_dir, path))
+    if path == os.curdir:
+        return
+
+    try:
+        if files is not None:
+            # Put in place the files the dir had when it was first watched.
+            if not os.path.isdir(full_path):
+                os.makedirs(full_path)
+            for name, file_size in files:
+                file_path = os.path.join(full_path, name)
+                if (not os.path.isfile(file_path) or
+                    os.path.getsize(file_path) != file_size):
+                    create_file(scratch_dir, file_path, file_size)
+        elif mask & inotifyx.IN_DELETE_SELF:
+            shutil.rmtree(full_path, ignore_errors=True)
+        elif mask & inotifyx.IN_ISDIR:
+            if mask & inotifyx.IN_MOVED_TO:
+                # Build the directory elsewhere and move it in place.
+                temp_dir = tempfile.mkdtemp(dir=scratch_dir, prefix='.')
+                os.rename(temp_dir, full_path)
+            elif not os.path.isdir(full_path):
+                os.makedirs(full_path)
+        elif mask & inotifyx.IN_MOVED_TO:
+            create_file(scratch_dir, full_path, size)
+        elif mask & inotifyx.IN_CREATE:
+            open(full_path, 'a').close()
+        elif mask & inotifyx.IN_CLOSE_WRITE:
+            with open(full_path, 'a') as changed_file:
+                if size >= 0:
+                    changed_file.truncate(size)
+    except (IOError, OSError):
+        # The recorded write patterns might not be reproducible, for example
+        # if the directory was removed in between.
+        logging.debug("Couldn't replay the event for '%s'." % path)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('trace', help="file with the recorded events")
+    parser.add_argument('--speed', type=float, default=1,
+                        help="how many times faster than recorded to replay")
+    parser.add_argument('--delay', type=float, default=None,
+                        help="settle delay for the monitor, instead of "
+                             "DELAY_BEFORE_RUN")
+    parser.add_argument('--white-list', nargs='*', default=['task-*'])
+    parser.add_argument('--black-list', nargs='*', default=['*'])
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    from trommons_script import DELAY_BEFORE_RUN, task_is_complete
+    delay = DELAY_BEFORE_RUN if options.delay is None else options.delay
+
+    events = read_trace(options.trace)
+    if not events:
+        print "No events in the trace."
+        return 1
+
+    scratch_dir = tempfile.mkdtemp(prefix="trommons-replay-")
+
+    # Times of the last replayed event for each top level directory, and of
+    # the runs for each of them.
+    lock = threading.Lock()
+    last_event = {}
+    runs = []
+
+    def record_run(change):
+        now = time.time()
+        names = os.listdir(change) if os.path.isdir(change) else []
+        with lock:
+            runs.append((change, now, last_event.get(change),
+                         task_is_complete(change, names)))
+
+    monitor = ChangeMonitor([scratch_dir], options.white_list,
+                            options.black_list, delay, task_is_complete)
+    runner = Runner(ReplayReporter(), monitor, False, True, record_run)
+    runner_thread = threading.Thread(target=runner.main_loop)
+    runner_thread.daemon = True
+    runner_thread.start()
+
+    start = time.time()
+    first = events[0][0]
+    for timestamp, mask, path, size, files in events:
+        wait = start + (timestamp - first) / options.speed - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        apply_event(scratch_dir, mask, path, size, files)
+
+        top = path.split(os.sep)[0]
+        if top != os.curdir:
+            with lock:
+                last_event[os.path.join(scratch_dir, top)] = time.time()
+
+    # Give the monitor time to report the last changes.
+    time.sleep(delay * 3 + 1)
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    with lock:
+        runs = list(runs)
+
+    latencies = [ran - event for change, ran, event, complete in runs
+                 if event is not None]
+    incomplete = sum(1 for change, ran, event, complete in runs
+                     if not complete)
+    seen = set()
+    repeated = 0
+    for change, ran, event, complete in runs:
+        if change in seen:
+            repeated += 1
+        seen.add(change)
+
+    print "Events replayed    : %d in %.2fs" % (len(events),
+                                                time.time() - start)
+    print "Directories changed: %d" % len(last_event)
+    print "Runs               : %d" % len(runs)
+    if runs:
+        print "Events per run     : %.1f" % (float(len(events)) / len(runs))
+    if latencies:
+        print "Trigger latency    : p50 %.3fs, p95 %.3fs, max %.3fs" % (
+            percentile(latencies, 0.5), percentile(latencies, 0.95),
+            max(latencies))
+    print "Spurious runs      : %d incomplete, %d repeated" % (incomplete,
+                                                               repeated)
+
+    # The white listed dirs that changed but were never reported.
+    missed = sorted(os.path.basename(change) for change in last_event
+                    if change not in seen and
+                    monitor.is_white_listed(os.path.basename(change)))
+    print "Directories missed : %d" % len(missed)
+    for name in missed:
+        print "    %s" % name
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -36,22 +36,64 @@ It is also recommended to perform some further tweaks on the Pootle server:
 
 """
 
+import codecs
+import datetime
+import errno
+import hashlib
+import importlib
 import json
 import logging
 import os
+import random
+import re
 import shutil
+import socket
+import sqlite3
+import stat
 import subprocess
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from tempfile import mkdtemp
 
-import slumber
+from trommons_metrics import metrics
+
+
+class LazyImport(object):
+    """Stand-in for a module, or something in it, imported when first used.
+
+    Importing Slumber, requests and Django takes a while, so they are imported
+    when a task needs them, letting the directory monitor start watching for
+    tasks as soon as possible.
+    """
+
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def __getattr__(self, name):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)
+            if self._attribute is not None:
+                target = getattr(target, self._attribute)
+            self._target = target
+        return getattr(self._target, name)
+
+
+requests = LazyImport('requests')
+slumber = LazyImport('slumber')
 
 # This must be run before importing Django.
 os.environ['DJANGO_SETTINGS_MODULE'] = 'pootle.settings'
 
-from django.conf import settings
+settings = LazyImport('django.conf', 'settings')
 
 
-# How long to wait for additional events after a function run is triggered.
+# How long the files in a task directory must stay the same before importing
+# the task.
 #
 # Moved to this file to have all the settings in this file instead of the
 # directory monitor script.
@@ -67,11 +109,81 @@ POOTLE_DIR = "/home/your-user/pootle/"
 # Directory where Pootle leaves stuff for Trommons.
 TROMMONS_DIR = "/home/your-user/trommons/"
 
+# Seconds between exports of the translated files back to Trommons. Only the
+# files changed since the last export are handed over. When several importers
+# share POOTLE_DIR only the one with INSTANCE_INDEX 0 exports them. Use None to
+# not export them.
+EXPORT_INTERVAL = None
+
+# File where the time of the last export and the size, modification time and
+# hash of the exported files are kept, to know which files changed since then.
+EXPORT_STATE_FILE = "/home/your-user/trommons_export.json"
+
+# Whether to import all the tasks that arrive together in a single batch, so
+# Pootle updates all their projects at once. When importing in batches the
+# worker pool is not used.
+BATCH_IMPORT = False
+
+# How to run the imports for the tasks. Use None to import them one after the
+# other, 'thread' to import several tasks at once using a pool of threads or
+# 'process' to do it using a pool of processes.
+WORKER_MODE = None
+
+# Number of tasks that can be imported at the same time when using a pool.
+WORKER_COUNT = 4
+
+# Maximum number of tasks waiting for a free worker. When the queue is full the
+# directory monitor waits before accepting more changes. Use 0 for no limit.
+WORKER_QUEUE_SIZE = 100
+
+# Order in which the waiting tasks are imported. Use 'smallest' to import first
+# the tasks with the smallest files, 'oldest' to import first the tasks that
+# arrived first, or 'priority' to import first the tasks with the highest
+# 'priority' field in the JSON file, and the smallest ones among those with the
+# same priority. Use None to import them in no particular order.
+SCHEDULE_POLICY = 'smallest'
+
+# Seconds a task has to wait to be imported before one with files twice as big,
+# or with a priority one higher. This makes sure that every task is imported
+# eventually. Use None to not take into account how long the tasks wait.
+SCHEDULE_AGING = 30
+
+# Size in bytes from which the files of a task make it a heavy task. When using
+# a pool, no more than HEAVY_WORKERS of the workers import heavy tasks at the
+# same time, so the rest are kept for the light tasks. Use None to not limit
+# them.
+HEAVY_TASK_SIZE = 5 * 1024 * 1024
+HEAVY_WORKERS = 1
+
+# Directory where each importer leaves a lease file for the tasks it is
+# importing, when several importers share POOTLE_DIR, so no task is imported by
+# two of them. It must be shared by all the importers. Use None when there is a
+# single importer.
+LEASE_DIR = None
+
+# Seconds a lease lasts. Leases are renewed while the task is imported, so a
+# task is only taken over by another importer when the one importing it
+# stopped. The clocks of the hosts must be in sync well within this time.
+LEASE_DURATION = 60
+
+# Number of importers sharing POOTLE_DIR, and the number of this one, from 0 to
+# INSTANCE_COUNT - 1. Each importer only imports the tasks whose id modulo
+# INSTANCE_COUNT is its number, so they seldom compete for the same leases. The
+# tasks of a stopped importer wait for it to start again. Use 1 to let every
+# importer import any task.
+INSTANCE_INDEX = 0
+INSTANCE_COUNT = 1
+
 
 # This is necessary when calling management commands.
 POOTLE_SETTINGS_FILE = ("/home/your-user/repos/pootle/pootle/settings/"
                         "90-dev-local.conf")
 
+# How to run the Pootle management commands. Use 'subprocess' to run the
+# `pootle` command for each of them, or 'inprocess' to run them inside this
+# process, which avoids loading Pootle again for every command.
+MANAGEMENT_COMMAND_MODE = 'subprocess'
+
 # Pootle API URL.
 API_URL = "http://localhost:8000/api/v1/"
 
@@ -80,68 +192,1165 @@ API_URL = "http://localhost:8000/api/v1/"
 # Must be a user with rights enough to create stuff and assign permissions.
 API_AUTH = ('api-user', 'api-user')
 
+# Seconds to wait for the Pootle API before giving up on a request.
+API_TIMEOUT = 60
+
+# Number of times a failed GET request to the Pootle API is retried, and the
+# seconds to wait before the first retry. The wait doubles with each retry.
+API_RETRIES = 3
+API_RETRY_BACKOFF = 0.5
+
+# Most requests sent at once to the Pootle API. The actual limit adapts to
+# how Pootle copes with them: it grows slowly while Pootle answers within the
+# target latency, and it is halved when Pootle answers slower or fails.
+API_MAX_IN_FLIGHT = 16
+API_TARGET_LATENCY = 2.0
+
+# Number of consecutive failures after which no more requests are sent to the
+# Pootle API, and no more tasks are started, for the given seconds.
+API_FAILURE_THRESHOLD = 5
+API_FAILURE_COOLDOWN = 30
+
+# Seconds after which the list of Pootle languages is retrieved again. Use None
+# to keep it until the daemon is restarted.
+LANGUAGE_INDEX_TTL = None
+
+# Number of users to remember as existing in Pootle.
+USER_CACHE_SIZE = 10000
+
+# Whether to retrieve the existing users when starting, instead of learning
+# about them as tasks are imported.
+USER_CACHE_WARM = False
+
+# Number of objects to retrieve on each request when listing languages or users.
+API_PAGE_SIZE = 200
+
+
+# File where the metrics are written in the Prometheus text format, for the
+# node exporter textfile collector. Use None to not write them.
+METRICS_FILE = None
+
+# Port on localhost where the metrics are served over HTTP in the /metrics
+# path. Use None to not serve them.
+METRICS_PORT = None
+
+# Seconds between writes of the metrics file.
+METRICS_INTERVAL = 15
+
+
+# How the directory monitor notices the changes in POOTLE_DIR. Use 'inotify'
+# for local file systems, or 'polling' for network file systems like NFS or
+# CIFS, where inotify doesn't see the changes made by other hosts.
+MONITOR_BACKEND = 'inotify'
+
+# Shortest and longest seconds between polls for the 'polling' backend. Polls
+# are done more often after a change and less often while nothing changes.
+POLL_INTERVAL_MIN = 0.2
+POLL_INTERVAL_MAX = 2.0
+
+# File where all the file system events seen by the directory monitor are
+# recorded, to replay them later with trommons_replay.py. Use None to not
+# record them.
+EVENT_TRACE_FILE = None
+
+# Directory where the profiles and memory snapshots are written. Send SIGUSR1
+# to the directory monitor to start profiling the imports, and again to stop
+# and write the profile. Send SIGUSR2 to write what was allocated since the
+# previous time. Imports run in worker processes are not profiled.
+PROFILE_DIR = "/tmp/"
+
+# Profile one of every given number of imports, writing each profile as soon
+# as the import finishes. Use None to only profile when asked to.
+PROFILE_EVERY = None
+
+
+# SQLite database where the stages finished for each task are recorded, so a
+# task interrupted halfway is resumed where it stopped, also after restarting
+# the daemon, instead of being imported again. Use None to not record them.
+JOURNAL_FILE = None
+
+
+# Largest translation file accepted, in bytes.
+MAX_TRANSLATION_FILE_SIZE = 50 * 1024 * 1024
+
+# Number of bytes read from the beginning of the translation file to check it
+# before importing it.
+PREFLIGHT_READ_SIZE = 64 * 1024
+
+# File extensions accepted for each Pootle file type, as provided in the
+# 'mime' field.
+FILE_EXTENSIONS = {
+    'po': ('po', 'pot'),
+    'xlf': ('xlf', 'xliff'),
+    'xliff': ('xlf', 'xliff'),
+    'ts': ('ts',),
+}
+
 
 # Filename of the JSON file used to exchange data. Have it in one place in case
 # we need to alter it.
 JSON_FILENAME = "meta.json"
 
 
+class PootleUnavailable(Exception):
+    """Raised when requests to the Pootle API are paused after failures."""
+
+
+class AdaptiveLimiter(object):
+    """Limits the number of requests sent at once to the Pootle API.
+
+    The limit is increased additively while requests succeed quickly, and it
+    is decreased multiplicatively when they fail or are slow.
+    """
+
+    def __init__(self, maximum, target_latency):
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until another request can be sent."""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait(0.5)
+            self.in_flight += 1
+
+    def release(self, latency, failed):
+        """Account a finished request and adapt the limit."""
+        with self.condition:
+            self.in_flight -= 1
+            if failed or latency > self.target_latency:
+                # Requests sent at the same time usually fail together, so
+                # decrease the limit once for all of them.
+                now = time.time()
+                if now - self.last_decrease > self.target_latency:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to Pootle for a while after several failures.
+
+    After the cooldown period a single request is let through, and its result
+    decides whether to keep the requests paused.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        """Return whether a request can be sent now."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.time() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, failed):
+        """Account the result of a request."""
+        with self.lock:
+            was_probing = self.probing
+            self.probing = False
+            if not failed:
+                if self.opened_at is not None:
+                    logging.info("The Pootle API is available again.")
+                self.failures = 0
+                self.opened_at = None
+                return
+
+            self.failures += 1
+            if was_probing or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.error("The Pootle API keeps failing. Pausing the "
+                                  "requests for %s seconds." % self.cooldown)
+                self.opened_at = time.time()
+
+    def is_open(self):
+        """Return whether the requests are paused."""
+        with self.lock:
+            return self.opened_at is not None
+
+    def wait(self):
+        """Block while the requests are paused, until a probe can be sent."""
+        while True:
+            with self.lock:
+                if self.opened_at is None:
+                    return
+                remaining = self.opened_at + self.cooldown - time.time()
+                if remaining <= 0 and not self.probing:
+                    return
+            time.sleep(min(max(remaining, 0.1), 1))
+
+
+class PootleSession(object):
+    """HTTP session for the Pootle API that keeps its connections open.
+
+    It also keeps count of the requests sent to each API resource and of the
+    time they took, so it is possible to check how much time is spent waiting
+    for Pootle.
+
+    Failed GET requests are retried, the number of requests sent at once is
+    limited by the limiter, and no requests are sent while the breaker is
+    open.
+
+    It is mixed with requests.Session when the API client is created, so
+    requests is only imported when needed.
+    """
+
+    def __init__(self, pool_size, timeout, limiter=None, breaker=None):
+        super(PootleSession, self).__init__()
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.timeout = timeout
+        self.limiter = limiter
+        self.breaker = breaker
+
+        # Maps (method, resource) to [count, total seconds, max seconds].
+        self.stats_lock = threading.Lock()
+        self.request_stats = {}
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        # Only requests that don't change anything can be safely retried.
+        retries = API_RETRIES if method.upper() == 'GET' else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                # Exponential backoff with full jitter.
+                time.sleep(random.uniform(0, API_RETRY_BACKOFF *
+                                             2 ** (attempt - 1)))
+            try:
+                response = self.send_once(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                if attempt == retries:
+                    raise
+                logging.warning("%s request to '%s' failed. Retrying." %
+                                (method, url))
+                continue
+
+            if response.status_code < 500 or attempt == retries:
+                return response
+            logging.warning("%s request to '%s' failed with status %d. "
+                            "Retrying." % (method, url, response.status_code))
+
+    def send_once(self, method, url, **kwargs):
+        """Send the request, accounting its result."""
+        if self.breaker is not None and not self.breaker.allow():
+            raise PootleUnavailable("Requests to the Pootle API are paused.")
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+        failed = True
+        start = time.time()
+        try:
+            response = super(PootleSession, self).request(method, url,
+                                                          **kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            elapsed = time.time() - start
+            self.record(method, url, elapsed)
+            if self.limiter is not None:
+                self.limiter.release(elapsed, failed)
+            if self.breaker is not None:
+                self.breaker.record(failed)
+
+    def record(self, method, url, elapsed):
+        """Account the time taken by a request."""
+        # Use the resource name, e.g. 'languages', instead of the full URL.
+        resource = url[len(API_URL):] if url.startswith(API_URL) else url
+        key = (method.upper(), resource.split('/')[0])
+
+        metrics.observe('api_request_seconds', elapsed, method=key[0],
+                        resource=key[1])
+
+        with self.stats_lock:
+            stats = self.request_stats.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+
+_api = None
+_session = None
+_api_pid = None
+_api_lock = threading.Lock()
+
+api_limiter = AdaptiveLimiter(API_MAX_IN_FLIGHT, API_TARGET_LATENCY)
+api_breaker = CircuitBreaker(API_FAILURE_THRESHOLD, API_FAILURE_COOLDOWN)
+metrics.gauge('api_concurrency_limit', lambda: int(api_limiter.limit))
+metrics.gauge('api_paused', lambda: int(api_breaker.is_open()))
+
+
+def get_api():
+    """Return the API client shared by all the imports.
+
+    The client is created the first time it is needed, and its connections to
+    Pootle are reused for all the tasks. Worker processes create their own,
+    since connections can't be shared with the parent process.
+    """
+    global _api, _session, _api_pid
+
+    with _api_lock:
+        if _api is None or _api_pid != os.getpid():
+            _api_pid = os.getpid()
+            session_class = type('PootleSession',
+                                 (PootleSession, requests.Session), {})
+            _session = session_class(WORKER_COUNT, API_TIMEOUT, api_limiter,
+                                     api_breaker)
+            _api = slumber.API(API_URL, auth=API_AUTH, session=_session)
+    return _api
+
+
+def close_api():
+    """Close the connections to the Pootle API."""
+    global _api, _session
+
+    with _api_lock:
+        if _session is not None:
+            _session.close()
+        _api = None
+        _session = None
+
+
+def wait_for_pootle():
+    """Block while requests to the Pootle API are paused after failures.
+
+    The directory monitor uses this to stop starting new imports while Pootle
+    is not working.
+    """
+    api_breaker.wait()
+
+
+def log_api_stats():
+    """Log how many requests were sent to the Pootle API and their latency."""
+    if _session is None:
+        return
+
+    with _session.stats_lock:
+        stats = sorted(_session.request_stats.items())
+
+    for (method, resource), (count, total, slowest) in stats:
+        logging.info("API %s %s: %d requests, %.3fs average, %.3fs max." %
+                     (method, resource, count, total / count, slowest))
+
+
+class LanguageIndex(object):
+    """Languages existing in Pootle, keyed by their case-folded code.
+
+    All the languages are retrieved at once, so checking if a language exists
+    doesn't require any request to the Pootle API.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.uris = None
+        self.loaded_at = None
+
+    def load(self, api):
+        """Retrieve all the languages using the Pootle API."""
+        uris = {}
+        offset = 0
+
+        while True:
+            # GET query to
+            # http://localhost:8000/api/v1/languages/?limit=200&offset=0
+            lang_data = api.languages.get(limit=API_PAGE_SIZE,
+                                          offset=offset)
+            for language in lang_data['objects']:
+                uris[language['code'].lower()] = language['resource_uri']
+
+            offset += len(lang_data['objects'])
+            if not lang_data['meta']['next'] or not lang_data['objects']:
+                break
+
+        with self.lock:
+            self.uris = uris
+            self.loaded_at = time.time()
+
+        logging.info("Loaded %d languages from Pootle." % len(uris))
+
+    def refresh(self):
+        """Forget the known languages so they are retrieved again."""
+        with self.lock:
+            self.uris = None
+
+    def expired(self):
+        """Return whether the languages must be retrieved again."""
+        with self.lock:
+            if self.uris is None:
+                return True
+            return (self.ttl is not None and
+                    time.time() - self.loaded_at > self.ttl)
+
+    def get(self, api, code):
+        """Return the API URI for the language code, or an empty string."""
+        if self.expired():
+            self.load(api)
+
+        with self.lock:
+            return self.uris.get(code.lower(), "")
+
+    def add(self, code, resource_uri):
+        """Remember a language that now exists in Pootle."""
+        with self.lock:
+            if self.uris is not None:
+                self.uris[code.lower()] = resource_uri
+
+
+class UserCache(object):
+    """Usernames known to exist in Pootle.
+
+    Only existing users are remembered, dropping the least recently used ones
+    when the cache is full. Unknown usernames are always checked using the
+    Pootle API, so users created meanwhile by someone else are found.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.usernames = OrderedDict()
+
+    def __contains__(self, username):
+        with self.lock:
+            if username not in self.usernames:
+                return False
+            # Mark it as the most recently used.
+            self.usernames[username] = self.usernames.pop(username)
+            return True
+
+    def add(self, username):
+        """Remember a user that exists in Pootle."""
+        with self.lock:
+            self.usernames.pop(username, None)
+            self.usernames[username] = True
+            while len(self.usernames) > self.size:
+                self.usernames.popitem(last=False)
+
+    def load(self, api):
+        """Retrieve the existing users using the Pootle API."""
+        offset = 0
+
+        while offset < self.size:
+            # GET query to
+            # http://localhost:8000/api/v1/users/?limit=200&offset=0
+            user_data = api.users.get(limit=API_PAGE_SIZE, offset=offset)
+            for user in user_data['objects']:
+                self.add(user['username'])
+
+            offset += len(user_data['objects'])
+            if not user_data['meta']['next'] or not user_data['objects']:
+                break
+
+        logging.info("Loaded %d users from Pootle." % len(self.usernames))
+
+
+class SingleFlight(object):
+    """Runs only one of several identical calls made at the same time.
+
+    The calls made while another one with the same key is running wait for it
+    and get its result, or its exception, instead of doing the same work.
+    """
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, *args):
+        """Call the function, unless a call for the key is already running."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = function(*args)
+            return call.result
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+class Journal(object):
+    """Records the import stages finished for each task in a SQLite database.
+
+    The data provided for the task is kept along with its finished stages, as
+    the task directory is removed before the last stages are run. The task is
+    forgotten once it is completely imported.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # The processes in the worker pool can't share the connection.
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30,
+                                              check_same_thread=False)
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                                        "task_dir TEXT PRIMARY KEY, "
+                                        "provided TEXT NOT NULL, "
+                                        "updated REAL NOT NULL)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, task_dir):
+        """Return the recorded data for the task, or None."""
+        with self.lock:
+            row = self.connect().execute("SELECT provided FROM tasks "
+                                         "WHERE task_dir = ?",
+                                         (task_dir,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save(self, task_dir, provided):
+        """Record the data for the task, including its finished stages."""
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO tasks "
+                                   "VALUES (?, ?, ?)",
+                                   (task_dir, json.dumps(provided),
+                                    time.time()))
+
+    def forget(self, task_dir):
+        """Remove the task once it is completely imported."""
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("DELETE FROM tasks WHERE task_dir = ?",
+                                   (task_dir,))
+
+    def unfinished(self):
+        """Return the directories of the tasks not completely imported."""
+        with self.lock:
+            rows = self.connect().execute("SELECT task_dir FROM tasks "
+                                          "ORDER BY updated").fetchall()
+        return [row[0] for row in rows]
+
+
+class Leases(object):
+    """Lease files claiming tasks among several importers.
+
+    A lease is a file created exclusively in the lease directory, holding a
+    token for its owner, and it is renewed by touching it while the task is
+    imported. A lease not renewed for its duration belongs to an importer that
+    stopped, so it can be taken over.
+    """
+
+    def __init__(self, directory, duration):
+        self.directory = directory
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.held = {}
+        self.renewer_pid = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".lease")
+
+    def read_token(self, path):
+        try:
+            with open(path) as lease_file:
+                return lease_file.read()
+        except (IOError, OSError):
+            return None
+
+    def acquire(self, name):
+        """Claim the lease for name, returning whether it was claimed."""
+        path = self.path(name)
+        token = "%s:%d:%08x" % (socket.gethostname(), os.getpid(),
+                                random.getrandbits(32))
+
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if attempt or not self.break_expired(path):
+                    return False
+                continue
+
+            try:
+                os.write(fd, token)
+            finally:
+                os.close(fd)
+
+            with self.lock:
+                self.held[name] = token
+            self.start_renewing()
+            return True
+
+        return False
+
+    def break_expired(self, path):
+        """Remove the lease if it expired, returning whether it is gone."""
+        try:
+            if time.time() - os.path.getmtime(path) <= self.duration:
+                return False
+        except OSError:
+            # Released meanwhile.
+            return True
+
+        stale_path = "%s.%08x.stale" % (path, random.getrandbits(32))
+        try:
+            os.rename(path, stale_path)
+        except OSError:
+            # Another importer removed it first.
+            return True
+
+        try:
+            # Another importer might have renewed or taken the lease over
+            # meanwhile, so make sure it was the expired lease that got
+            # removed. If it can't be put back its owner loses it, and notices
+            # before running the next import stage.
+            if time.time() - os.path.getmtime(stale_path) <= self.duration:
+                try:
+                    os.link(stale_path, path)
+                except OSError:
+                    pass
+                return False
+        finally:
+            os.unlink(stale_path)
+
+        logging.warning("Took over the expired lease '%s'." % path)
+        return True
+
+    def holds(self, name):
+        """Return whether the lease for name is still held."""
+        with self.lock:
+            token = self.held.get(name)
+        return token is not None and self.read_token(self.path(name)) == token
+
+    def release(self, name):
+        """Give up the lease for name, if it is still held."""
+        with self.lock:
+            token = self.held.pop(name, None)
+
+        path = self.path(name)
+        if token is not None and self.read_token(path) == token:
+            os.unlink(path)
+
+    def start_renewing(self):
+        """Renew the held leases in the background, once per process."""
+        with self.lock:
+            if self.renewer_pid == os.getpid():
+                return
+            self.renewer_pid = os.getpid()
+
+        thread = threading.Thread(target=self.renew_periodically)
+        thread.daemon = True
+        thread.start()
+
+    def renew_periodically(self):
+        while True:
+            time.sleep(self.duration / 3.0)
+
+            with self.lock:
+                held = self.held.items()
+
+            for name, token in held:
+                path = self.path(name)
+                if self.read_token(path) != token:
+                    logging.warning("Lost the lease for '%s'." % name)
+                    continue
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    logging.exception("Couldn't renew the lease for '%s'." %
+                                      name)
+
+
+languages = LanguageIndex(LANGUAGE_INDEX_TTL)
+users = UserCache(USER_CACHE_SIZE)
+flights = SingleFlight()
+journal = Journal(JOURNAL_FILE) if JOURNAL_FILE else None
+leases = Leases(LEASE_DIR, LEASE_DURATION) if LEASE_DIR else None
+
+
+_django_ready = False
+_django_lock = threading.Lock()
+
+
+def setup_django():
+    """Load Pootle in this process so management commands can be run."""
+    global _django_ready
+
+    with _django_lock:
+        if not _django_ready:
+            os.environ['POOTLE_SETTINGS'] = POOTLE_SETTINGS_FILE
+
+            import django
+            if hasattr(django, 'setup'):
+                django.setup()
+
+            # Accessing the settings makes Django load them now.
+            settings.INSTALLED_APPS
+            _django_ready = True
+
+
+# Management commands are not meant to run at the same time in one process.
+_command_lock = threading.Lock()
+
+
+def run_management_command(name, *args):
+    """Run the Pootle management command with the given command line arguments.
+
+    An exception is raised if the command fails.
+    """
+    if MANAGEMENT_COMMAND_MODE == 'inprocess':
+        call_management_command(name, list(args))
+    else:
+        subprocess.check_call(["pootle", name] + list(args))
+
+
+def call_management_command(name, args):
+    """Run the Pootle management command inside this process."""
+    setup_django()
+
+    from django.core.management import get_commands, load_command_class
+    from django.db import connection
+
+    command = load_command_class(get_commands()[name], name)
+
+    # Parse the arguments as the command line would, so both ways of running
+    # the commands accept the same arguments.
+    parsed = command.create_parser("pootle", name).parse_args(args)
+    if isinstance(parsed, tuple):
+        # Django before 1.8 uses optparse.
+        options, positional = parsed
+        options = vars(options)
+    else:
+        options = vars(parsed)
+        positional = options.pop('args', [])
+
+    # Don't run the system checks on every command, like call_command does.
+    options.setdefault('skip_checks', True)
+
+    with _command_lock:
+        try:
+            command.execute(*positional, **options)
+        except SystemExit as e:
+            # Some Django versions exit when the command fails.
+            if e.code:
+                logging.error("The '%s' management command failed." % name)
+                raise Exception
+        finally:
+            # Don't keep the database connection open between tasks.
+            connection.close()
+
+
+def warm_up():
+    """Prepare the API client and the caches before the first task arrives."""
+    if MANAGEMENT_COMMAND_MODE == 'inprocess':
+        setup_django()
+
+    languages.load(get_api())
+
+    if USER_CACHE_WARM:
+        users.load(get_api())
+
+
+def claim_task(changed_dir_path):
+    """Return whether this importer must import the task, claiming it.
+
+    The task is left for another importer if it belongs to another instance,
+    or another importer holds its lease.
+    """
+    name = os.path.basename(changed_dir_path)
+
+    if INSTANCE_COUNT > 1:
+        match = re.match(r"task-(\d+)$", name)
+        if match:
+            number = int(match.group(1))
+        else:
+            number = zlib.crc32(name) & 0xffffffff
+        if number % INSTANCE_COUNT != INSTANCE_INDEX:
+            logging.info("Leaving '%s' for another importer." % name)
+            return False
+
+    if leases is not None and not leases.acquire(name):
+        logging.info("'%s' is being imported by another importer." % name)
+        return False
+
+    return True
+
+
+def ensure_task_claimed(changed_dir_path):
+    """Make sure no other importer took the task over.
+
+    This is checked before the stages that can't be run twice.
+    """
+    name = os.path.basename(changed_dir_path)
+    if leases is not None and not leases.holds(name):
+        logging.error("The lease for '%s' was taken by another importer. "
+                      "Aborting." % name)
+        raise Exception
+
+
+def release_task(changed_dir_path):
+    """Let other importers claim the task again."""
+    if leases is not None:
+        leases.release(os.path.basename(changed_dir_path))
+
+
+def interrupted_tasks():
+    """Return the directories of the tasks whose import was interrupted."""
+    if journal is None:
+        return []
+    return journal.unfinished()
+
+
+def setup_environment():
+    """Prepare the environment required by the import stages."""
+    # It is necessary to set the POOTLE_SETTINGS environment variable before
+    # calling the Pootle management commands.
+    os.environ['POOTLE_SETTINGS'] = POOTLE_SETTINGS_FILE
+
+
 def run_stuff(changed_dir_path):
     """Run all the machinery for importing a project from Trommons task.
     
     This creates any object required, imports the translation file, and assigns
-    the necessary permissions to the translator.
+    the necessary permissions to the translator. PootleUnavailable is raised if
+    the requests to Pootle get paused before anything was changed, so the task
+    can be run again later.
+
+    Returns whether the task was imported, or None if it was left for another
+    importer.
     """
-    # It is necessary to set the POOTLE_SETTINGS environment variable before
-    # calling the Pootle management commands.
-    os.environ['POOTLE_SETTINGS'] = POOTLE_SETTINGS_FILE
+    setup_environment()
+
+    # Worker processes have their own breaker, so wait for it here too.
+    wait_for_pootle()
+
+    # Make sure no other importer imports the task at the same time.
+    if not claim_task(changed_dir_path):
+        return None
+
+    try:
+        # Get the API client to use for all the queries to Pootle API.
+        API_OBJ = get_api()
+
+        provided = load_task(changed_dir_path)
+        try:
+            import_task(API_OBJ, changed_dir_path, provided)
+        except PootleUnavailable:
+            # Not a failure of the task. If nothing was changed yet the
+            # caller runs it again later, otherwise the finished stages are
+            # only known here, so go on once Pootle is available.
+            if not provided.get('finished_stages'):
+                raise
+            while_available(import_task, API_OBJ, changed_dir_path, provided)
+    except PootleUnavailable:
+        raise
+    except:
+        metrics.inc('tasks_total', result='failure')
+        logging.exception("Something wrong happened. Aborting.")
+        return False
+    else:
+        metrics.inc('tasks_total', result='success')
+        return True
+    finally:
+        release_task(changed_dir_path)
+
 
-    # Set the default logging level to INFO, which makes easier to check that
-    # everything works as expected.
-    logging.basicConfig(level=logging.INFO)
+def run_batch(changed_dir_paths):
+    """Run all the machinery for importing several projects at once.
 
+    The per task stages are run for every task first, then all the translation
+    files are imported at once and finally the permissions are assigned and
+    Trommons is notified for every task. A task failing doesn't stop the
+    import of the rest of the tasks.
+    """
+    setup_environment()
+
+    # Make sure no other importer imports the tasks at the same time.
+    claimed = [changed_dir_path for changed_dir_path in changed_dir_paths
+               if claim_task(changed_dir_path)]
+    try:
+        import_batch(claimed)
+    finally:
+        for changed_dir_path in claimed:
+            release_task(changed_dir_path)
+
+
+def import_batch(changed_dir_paths):
+    """Import the already claimed tasks at once."""
+    read = []
+    for changed_dir_path in changed_dir_paths:
+        try:
+            read.append((changed_dir_path, load_task(changed_dir_path)))
+        except:
+            metrics.inc('tasks_total', result='failure')
+            logging.exception("Something wrong happened with '%s'. Aborting." %
+                              changed_dir_path)
+
+    if not read:
+        return
+
+    # Create the objects missing in Pootle for all the tasks at once. Anything
+    # that couldn't be created this way is created for each task afterwards.
+    api = get_api()
     try:
-        # Initialize API client to use for all the queries to Pootle API.
-        API_OBJ = slumber.API(API_URL, auth=API_AUTH)
+        create_objects_in_bulk(api, [provided for path, provided in read
+                                     if leases is None or
+                                     leases.holds(os.path.basename(path))])
+    except:
+        logging.exception("Couldn't create the objects for all the tasks at "
+                          "once. Creating them for each task.")
+
+    prepared = []
+    for changed_dir_path, provided in read:
+        try:
+            while_available(create_task_objects, api, changed_dir_path,
+                            provided)
+            prepared.append((changed_dir_path, provided))
+        except:
+            metrics.inc('tasks_total', result='failure')
+            logging.exception("Something wrong happened with '%s'. Aborting." %
+                              changed_dir_path)
+
+    if not prepared:
+        return
+
+    # Import the translation files for all the projects. If that fails import
+    # them one by one so only the projects that are really failing are left.
+    pending = [(changed_dir_path, provided)
+               for changed_dir_path, provided in prepared
+               if not stage_finished(provided, 'import')]
+    try:
+        if pending:
+            update_translation_projects([provided['project_code']
+                                         for path, provided in pending])
+    except:
+        logging.exception("Couldn't import the translation files at once. "
+                          "Importing them one by one.")
+        for changed_dir_path, provided in pending:
+            try:
+                update_translation_projects([provided['project_code']])
+                finish_stage(changed_dir_path, provided, 'import')
+            except:
+                metrics.inc('tasks_total', result='failure')
+                logging.exception("Something wrong happened with '%s'. "
+                                  "Aborting." % changed_dir_path)
+        prepared = [(changed_dir_path, provided)
+                    for changed_dir_path, provided in prepared
+                    if stage_finished(provided, 'import')]
+    else:
+        for changed_dir_path, provided in pending:
+            finish_stage(changed_dir_path, provided, 'import')
 
-        # Make sure the required files are in the directory.
-        ensure_files(changed_dir_path, JSON_FILENAME)
+    for changed_dir_path, provided in prepared:
+        try:
+            while_available(finish_task, changed_dir_path, provided)
+        except:
+            metrics.inc('tasks_total', result='failure')
+            logging.exception("Something wrong happened with '%s'. Aborting." %
+                              changed_dir_path)
+        else:
+            metrics.inc('tasks_total', result='success')
 
-        # Get the data from the JSON file.
-        provided = parse_input_json(changed_dir_path, JSON_FILENAME)
 
-        # Make sure that in the provided JSON there are all the data we need.
-        validate_provided_data(provided)
+def import_task(api, changed_dir_path, provided):
+    """Run the import stages not finished yet for the task."""
+    # Create all the required objects and put the translation file in place.
+    create_task_objects(api, changed_dir_path, provided)
 
-        # Add a custom field for further use.
-        provided['project_code'] = "task-%d" % provided['task_id']
+    # Import the translation file for the project.
+    if not stage_finished(provided, 'import'):
+        update_translation_projects([provided['project_code']])
+        finish_stage(changed_dir_path, provided, 'import')
 
-        # Make sure the required languages exist.
-        source_lang_api_uri = ensure_languages(API_OBJ, provided)
+    # Assign permissions and notify Trommons.
+    finish_task(changed_dir_path, provided)
 
-        # Get the URL for the project for Trommons to use. This requires
-        # setting a proper Site in Pootle admin.
-        proj_backlink = create_new_project(API_OBJ, provided,
-                                           source_lang_api_uri)
 
-        # Import the translation file for the project.
-        import_project_file(changed_dir_path, provided)
+def while_available(function, *args):
+    """Call the function, again each time the Pootle requests get paused."""
+    while True:
+        try:
+            return function(*args)
+        except PootleUnavailable:
+            logging.warning("The Pootle API is paused, waiting to go on.")
+            wait_for_pootle()
 
-        # Make sure the user exists, or create it if not.
-        ensure_user(API_OBJ, provided['assignee_id'])
 
-        # Assign the user the necessary permissions in the project.
+def load_task(changed_dir_path):
+    """Return the task data, as recorded in the journal if it was interrupted.
+
+    Otherwise the task data is read from the task directory.
+    """
+    if journal is not None:
+        provided = journal.get(changed_dir_path)
+        if provided is not None:
+            logging.info("Resuming the import of '%s' after the stages %s." %
+                         (changed_dir_path,
+                          ", ".join(provided['finished_stages'])))
+            return provided
+
+    return read_task(changed_dir_path)
+
+
+def stage_finished(provided, stage):
+    """Return whether the given import stage was already run for the task."""
+    return stage in provided.get('finished_stages', ())
+
+
+def finish_stage(changed_dir_path, provided, stage):
+    """Record that the given import stage was run for the task."""
+    provided.setdefault('finished_stages', []).append(stage)
+    if journal is not None:
+        journal.save(changed_dir_path, provided)
+
+
+def read_task(changed_dir_path):
+    """Read and check the task data provided by Trommons.
+
+    The provided data is returned, with some custom fields added for the rest
+    of the stages.
+    """
+    # Make sure the required files are in the directory.
+    ensure_files(changed_dir_path, JSON_FILENAME)
+
+    # Get the data from the JSON file.
+    provided = parse_input_json(changed_dir_path, JSON_FILENAME)
+
+    # Make sure that in the provided JSON there are all the data we need.
+    validate_provided_data(provided)
+
+    # Make sure the translation file looks usable before creating anything.
+    check_translation_file(changed_dir_path, provided)
+
+    # Add a custom field for further use.
+    provided['project_code'] = "task-%d" % provided['task_id']
+
+    return provided
+
+
+def create_task_objects(api, changed_dir_path, provided):
+    """Create the Pootle objects for the task and put its file in place.
+
+    The project is not created if it was already created in bulk, and the
+    stages already run for an interrupted task are skipped.
+    """
+    # Make sure the required languages exist.
+    source_lang_api_uri = ensure_languages(api, provided)
+
+    # Get the URL for the project for Trommons to use. This requires setting a
+    # proper Site in Pootle admin.
+    if not stage_finished(provided, 'project'):
+        if 'project_backlink' not in provided:
+            ensure_task_claimed(changed_dir_path)
+            provided['project_backlink'] = create_new_project(
+                api, provided, source_lang_api_uri)
+        finish_stage(changed_dir_path, provided, 'project')
+
+    # Put the translation file in the project directory.
+    if not stage_finished(provided, 'file'):
+        ensure_task_claimed(changed_dir_path)
+        move_project_file(changed_dir_path, provided)
+        finish_stage(changed_dir_path, provided, 'file')
+
+    # Make sure the user exists, or create it if not.
+    ensure_user(api, provided['assignee_id'])
+
+
+def finish_task(changed_dir_path, provided):
+    """Run the import stages required after importing the translation file."""
+    # Remove the directory provided by Trommons.
+    if not stage_finished(provided, 'remove'):
+        remove_task_dir(changed_dir_path)
+        finish_stage(changed_dir_path, provided, 'remove')
+
+    # Assign the user the necessary permissions in the project.
+    if not stage_finished(provided, 'permissions'):
         assign_user_to_project(provided['assignee_id'],
                                provided['project_code'])
+        finish_stage(changed_dir_path, provided, 'permissions')
 
-        # Import finished, so notify Trommons.
-        notify_trommons(provided['project_code'], proj_backlink, JSON_FILENAME,
-                        TROMMONS_DIR)
-    except:
-        logging.exception("Something wrong happened. Aborting.")
+    # Import finished, so notify Trommons.
+    notify_trommons(provided['project_code'], provided['project_backlink'],
+                    JSON_FILENAME, TROMMONS_DIR)
+
+    if journal is not None:
+        journal.forget(changed_dir_path)
 
 ###############################################################################
 
+def describe_task(changed_dir_path):
+    """Return the size of the files, the priority and arrival time of a task.
+
+    These are only used to decide the order in which the waiting tasks are
+    imported, so any problem reading them is left for the import to report.
+    """
+    size = 0
+    priority = 0
+    arrived = time.time()
+
+    try:
+        arrived = os.stat(changed_dir_path).st_mtime
+        for filename in os.listdir(changed_dir_path):
+            size += os.path.getsize(os.path.join(changed_dir_path, filename))
+
+        with open(os.path.join(changed_dir_path, JSON_FILENAME)) as json_file:
+            priority = int(json.load(json_file).get('priority', 0))
+    except (IOError, OSError, ValueError, TypeError, AttributeError):
+        pass
+
+    return size, priority, arrived
+
+
+def task_is_complete(changed_dir_path, filenames):
+    """Return whether all the files for the task have been provided.
+
+    This is used by the directory monitor to wait for Trommons to finish
+    writing the task directory.
+    """
+    return JSON_FILENAME in filenames and len(filenames) == 2
+
+
+@metrics.timed('ensure_files')
 def ensure_files(changed_dir_path, json_filename):
     """Make sure the required files are in place.
     
@@ -175,6 +1384,7 @@ def ensure_files(changed_dir_path, json_filename):
         raise Exception
 
 
+@metrics.timed('parse_input_json')
 def parse_input_json(base_dir, json_filename):
     """Parse the provided JSON file."""
     try:
@@ -189,6 +1399,7 @@ def parse_input_json(base_dir, json_filename):
     return provided
 
 
+@metrics.timed('validate_provided_data')
 def validate_provided_data(provided):
     """Ensure that all the required data is provided using the right types."""
     required = {
@@ -219,9 +1430,123 @@ def validate_provided_data(provided):
     logging.info("The provided JSON file has all the required data.")
 
 
+@metrics.timed('check_translation_file')
+def check_translation_file(base_dir, provided):
+    """Ensure that the translation file can be imported.
+
+    Only the beginning of the file is read, so this is cheap even for huge
+    files.
+    """
+    filename = provided['translation_filename']
+    if (os.path.basename(filename) != filename or
+        filename in (os.curdir, os.pardir, JSON_FILENAME)):
+        logging.error("The '%s' translation filename is not valid. Aborting." %
+                      filename)
+        raise Exception
+
+    extension = os.path.splitext(filename)[1][1:].lower()
+    if extension not in FILE_EXTENSIONS.get(provided['mime'],
+                                            (provided['mime'],)):
+        logging.error("The '%s' translation file is not of the '%s' type. "
+                      "Aborting." % (filename, provided['mime']))
+        raise Exception
+
+    path = os.path.join(base_dir, filename)
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        logging.error("The '%s' translation file is not present. Aborting." %
+                      filename)
+        raise
+
+    if not stat.S_ISREG(file_stat.st_mode):
+        logging.error("The '%s' translation file is not a regular file. "
+                      "Aborting." % filename)
+        raise Exception
+    if not 0 < file_stat.st_size <= MAX_TRANSLATION_FILE_SIZE:
+        logging.error("The '%s' translation file is empty or bigger than %d "
+                      "bytes. Aborting." % (filename, MAX_TRANSLATION_FILE_SIZE))
+        raise Exception
+
+    with open(path, 'rb') as translation_file:
+        head = translation_file.read(PREFLIGHT_READ_SIZE)
+
+    if extension in ('po', 'pot'):
+        check_po_head(filename, head)
+    else:
+        check_xml_head(filename, head)
+
+    logging.info("The '%s' translation file looks right." % filename)
+
+
+def check_encoding(filename, head, encoding):
+    """Ensure the beginning of the file can be decoded with the encoding."""
+    try:
+        # The head might end in the middle of a character, which is fine.
+        codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+    except (LookupError, UnicodeDecodeError):
+        logging.error("The '%s' translation file is not valid %s. Aborting." %
+                      (filename, encoding))
+        raise Exception
+
+
+def check_po_head(filename, head):
+    """Ensure the beginning of the file looks like a PO file."""
+    if head.startswith(codecs.BOM_UTF8):
+        head = head[len(codecs.BOM_UTF8):]
+
+    if 'msgid' not in head:
+        logging.error("The '%s' translation file is not a PO file. Aborting." %
+                      filename)
+        raise Exception
+
+    match = re.search(r'charset=([\w.:-]+)', head)
+    encoding = match.group(1) if match else 'utf-8'
+    if encoding.upper() == 'CHARSET':
+        # Left untouched from the template, read as UTF-8 by the toolkit.
+        encoding = 'utf-8'
+    check_encoding(filename, head, encoding)
+
+
+def check_xml_head(filename, head):
+    """Ensure the beginning of the file looks like an XML file."""
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8'),
+                          (codecs.BOM_UTF16_LE, 'utf-16-le'),
+                          (codecs.BOM_UTF16_BE, 'utf-16-be')):
+        if head.startswith(bom):
+            head = head[len(bom):]
+            break
+    else:
+        match = re.match(r'\s*<\?xml[^>]*encoding=["\']([\w.:-]+)', head)
+        encoding = match.group(1) if match else 'utf-8'
+
+    check_encoding(filename, head, encoding)
+    if not head.decode(encoding, 'ignore').lstrip().startswith(u'<'):
+        logging.error("The '%s' translation file is not an XML file. "
+                      "Aborting." % filename)
+        raise Exception
+
+
 def get_language_api_uri(api, code):
     """Return the URI in the Pootle API for the given language code.
 
+    If the language doesn't exist in Pootle then an empty string is returned.
+    """
+    resource_uri = languages.get(api, code)
+    if resource_uri:
+        return resource_uri
+
+    # The language might have been added in Pootle after loading the
+    # languages, so check it before trying to create it.
+    resource_uri = lookup_language_api_uri(api, code)
+    if resource_uri:
+        languages.add(code, resource_uri)
+    return resource_uri
+
+
+def lookup_language_api_uri(api, code):
+    """Query the Pootle API for the URI of the given language code.
+
     If the language doesn't exist in Pootle then an empty string is returned.
     """
     # GET query to http://localhost:8000/api/v1/languages/?code__iexact=en_US
@@ -236,6 +1561,7 @@ def get_language_api_uri(api, code):
         return ""
 
 
+@metrics.timed('ensure_languages')
 def ensure_languages(api, provided):
     """Make sure the necessary languages exist.
 
@@ -243,27 +1569,48 @@ def ensure_languages(api, provided):
 
     The API URI for the source language is returned for creating the project.
     """
-    source_lang_api_uri = get_language_api_uri(api, provided['source_code'])
+    source_lang_api_uri = ensure_language(api, provided['source_code'],
+                                          provided['source_name'])
+    ensure_language(api, provided['target_code'], provided['target_name'])
 
-    if source_lang_api_uri:
-        logging.info("Language '%s' already exists." % provided['source_code'])
-    else:
-        logging.info("Language '%s' doesn't exist." % provided['source_code'])
-        create_new_language(api, provided['source_code'],
-                            provided['source_name'])
+    return source_lang_api_uri
+
+
+def ensure_language(api, code, fullname):
+    """Make sure the language exists, returning its API URI.
+
+    Tasks imported at the same time that need the same language share the
+    lookup and creation of the language.
+    """
+    return flights.do(('language', code.lower()), _ensure_language, api, code,
+                      fullname)
+
+
+def _ensure_language(api, code, fullname):
+    lang_api_uri = get_language_api_uri(api, code)
 
-    if get_language_api_uri(api, provided['target_code']):
-        logging.info("Language '%s' already exists." % provided['target_code'])
+    if lang_api_uri:
+        logging.info("Language '%s' already exists." % code)
     else:
-        logging.info("Language '%s' doesn't exist." % provided['target_code'])
-        create_new_language(api, provided['target_code'],
-                            provided['target_name'])
+        logging.info("Language '%s' doesn't exist." % code)
+        try:
+            lang_api_uri = create_new_language(api, code, fullname)
+        except slumber.exceptions.SlumberHttpBaseException:
+            # Another process might have created the language meanwhile.
+            lang_api_uri = lookup_language_api_uri(api, code)
+            if not lang_api_uri:
+                raise
+            languages.add(code, lang_api_uri)
+            logging.info("Language '%s' was created meanwhile." % code)
 
-    return source_lang_api_uri
+    return lang_api_uri
 
 
 def create_new_language(api, code, fullname):
-    """Create a new language in Pootle using the Pootle API."""
+    """Create a new language in Pootle using the Pootle API.
+
+    The API URI for the new language is returned.
+    """
     language_data = {
         'code': code,
         'fullname': fullname,
@@ -271,7 +1618,7 @@ def create_new_language(api, code, fullname):
     }
 
     try:
-        api.languages.post(language_data)
+        new_lang = api.languages.post(language_data)
     except slumber.exceptions.HttpServerError:
         logging.error("Some problem occurred while trying to create a new "
                       "language using the Pootle API. Aborting.")
@@ -279,9 +1626,19 @@ def create_new_language(api, code, fullname):
 
     logging.info("Succesfully created language '%s'." % code)
 
+    # The API only returns the new language if it is configured to always
+    # return data, so ask for it otherwise.
+    if isinstance(new_lang, dict) and new_lang.get('resource_uri'):
+        resource_uri = new_lang['resource_uri']
+    else:
+        resource_uri = lookup_language_api_uri(api, code)
+
+    languages.add(code, resource_uri)
+    return resource_uri
 
-def create_new_project(api, provided, source_lang_api_uri):
-    """Create a new language in Pootle using the Pootle API."""
+
+def get_project_data(provided, source_lang_api_uri):
+    """Return the data for creating the project using the Pootle API."""
     # Assemble the description for the project.
     #
     # In order to get this working it is necessary to not set a specific markup
@@ -289,7 +1646,7 @@ def create_new_project(api, provided, source_lang_api_uri):
     description = ('%s\n\nTask in Trommons: %s' % (provided['description'],
                                                    provided['backlink']))
 
-    project_data = {
+    return {
         'code': provided['project_code'],
         'fullname': provided['title'],
         'description': description,
@@ -298,6 +1655,12 @@ def create_new_project(api, provided, source_lang_api_uri):
         'translation_projects': [],
     }
 
+
+@metrics.timed('create_new_project')
+def create_new_project(api, provided, source_lang_api_uri):
+    """Create a new project in Pootle using the Pootle API."""
+    project_data = get_project_data(provided, source_lang_api_uri)
+
     try:
         # This depends on having
         # http://django-tastypie.readthedocs.org/en/latest/resources.html#always-return-data
@@ -313,40 +1676,103 @@ def create_new_project(api, provided, source_lang_api_uri):
     return new_proj['backlink']
 
 
-def import_project_file(base_dir, provided):
-    """Import the translation file for the given project."""
+@metrics.timed('move_project_file')
+def move_project_file(base_dir, provided):
+    """Put the translation file for the given project in PODIRECTORY."""
 
     # It is not necessary to create the directory because when creating it
     # using the API it already creates the project directory here for us.
     project_dir = os.path.join(settings.PODIRECTORY, provided['project_code'])
 
-    # Create the target language directory.
     language_dir = os.path.join(project_dir, provided['target_code'])
+    source = os.path.join(base_dir, provided['translation_filename'])
+    destination = os.path.join(language_dir, provided['translation_filename'])
+
+    # The file might have been moved just before the import was interrupted.
+    if not os.path.exists(source) and os.path.exists(destination):
+        logging.info("The translation file was already moved to '%s'" %
+                     language_dir)
+        return
+
+    # Create the target language directory. An empty one is left if the import
+    # was interrupted right after creating it.
     try:
         os.mkdir(language_dir)
-    except OSError:
-        logging.error("The language directory in PODIRECTORY already exists.")
-        raise
+    except OSError as e:
+        if e.errno != errno.EEXIST or os.listdir(language_dir):
+            logging.error("The language directory in PODIRECTORY already "
+                          "exists.")
+            raise
     logging.info("Succesfully created directory '%s'" % language_dir)
 
     # Move the translation file to the target language directory.
-    shutil.move(os.path.join(base_dir, provided['translation_filename']),
-                os.path.join(language_dir, provided['translation_filename']))
+    transfer_file(source, destination)
     logging.info("Succesfully moved translation file to '%s'" % language_dir)
 
-    # Now run the management command to actually import the translation file.
-    cmd_args = [
-        "pootle",
-        "update_translation_projects",
-        "--project",
-        provided['project_code'],
-    ]
-    subprocess.call(cmd_args)
-    logging.info("Sucessfully imported the translation file.")
-
-    # Remove the directory provided by Trommons (including all the files and
-    # subdirectories within it).
-    shutil.rmtree(base_dir)
+
+def transfer_file(source, destination):
+    """Move the file, avoiding to copy it if possible.
+
+    If both paths are in the same filesystem the file is just renamed.
+    Otherwise it is copied next to the destination and then renamed, so the
+    destination file never appears partially written.
+    """
+    try:
+        os.rename(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    temp_path = os.path.join(os.path.dirname(destination),
+                             ".%s.tmp" % os.path.basename(destination))
+    try:
+        copy_file(source, temp_path)
+        shutil.copystat(source, temp_path)
+        os.rename(temp_path, destination)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    os.unlink(source)
+
+
+def copy_file(source, destination):
+    """Copy the file contents in big blocks.
+
+    Python 2 has neither copy_file_range() nor sendfile(), so the contents
+    pass through this process.
+    """
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            shutil.copyfileobj(source_file, destination_file, 1024 * 1024)
+
+
+@metrics.timed('update_translation_projects')
+def update_translation_projects(project_codes):
+    """Import the translation files for the given projects."""
+    cmd_args = []
+    for project_code in project_codes:
+        cmd_args.extend(["--project", project_code])
+
+    # Run the management command to actually import the translation files.
+    run_management_command("update_translation_projects", *cmd_args)
+    logging.info("Sucessfully imported the translation files for %s." %
+                 ", ".join(project_codes))
+
+
+@metrics.timed('remove_task_dir')
+def remove_task_dir(base_dir):
+    """Remove the directory provided by Trommons.
+
+    This includes all the files and subdirectories within it.
+    """
+    try:
+        shutil.rmtree(base_dir)
+    except OSError as e:
+        # It might have been removed just before the import was interrupted.
+        if e.errno != errno.ENOENT:
+            raise
     logging.info("Sucessfully removed directory provided by Trommons.")
 
 
@@ -367,53 +1793,187 @@ def create_new_user(api, username):
     logging.info("Succesfully created user '%s'." % username)
 
 
-def ensure_user(api, username):
-    """Make sure the necessary user exists.
-
-    If it doesn't exist, it is created using the Pootle API.
-    """
+def user_exists(api, username):
+    """Return whether the user exists in Pootle, asking the Pootle API."""
     # GET query to http://localhost:8000/api/v1/users/?username__exact=sauron
     # assuming that the provided username is "sauron".
     user_data = api.users.get(username__exact=username)
 
-    # lang_data['meta']['total_count'] holds the number of resources that match
+    # user_data['meta']['total_count'] holds the number of resources that match
     # the query.
-    user_exists = user_data['meta']['total_count'] == 1
+    return user_data['meta']['total_count'] == 1
 
-    if user_exists:
+
+@metrics.timed('ensure_user')
+def ensure_user(api, username):
+    """Make sure the necessary user exists.
+
+    If it doesn't exist, it is created using the Pootle API. Tasks imported at
+    the same time for the same user share the lookup and creation of the user.
+    """
+    if username in users:
+        logging.info("User '%s' already exists." % username)
+    else:
+        flights.do(('user', username), _ensure_user, api, username)
+
+
+def _ensure_user(api, username):
+    if user_exists(api, username):
         logging.info("User '%s' already exists." % username)
     else:
         logging.info("User '%s' doesn't exist." % username)
-        create_new_user(api, username)
+        try:
+            create_new_user(api, username)
+        except slumber.exceptions.SlumberHttpBaseException:
+            # Somebody else might have created the user meanwhile.
+            if not user_exists(api, username):
+                raise
+            logging.info("User '%s' was created meanwhile." % username)
+
+    users.add(username)
+
+
+def create_in_bulk(resource, objects, key):
+    """Create several objects with a single request using the Pootle API.
+
+    The objects are sent in a PATCH request to the list endpoint of the
+    resource. A dictionary mapping the key field of each created object to
+    the data returned for it is returned, or None if the request failed. The
+    dictionary is empty if the API doesn't return the data for the new
+    objects.
+    """
+    try:
+        # PATCH query to http://localhost:8000/api/v1/languages/ with
+        # {"objects": [...]} for creating languages.
+        response = resource.patch({'objects': objects})
+    except slumber.exceptions.SlumberHttpBaseException:
+        logging.exception("Couldn't create several objects at once using the "
+                          "Pootle API.")
+        return None
+
+    created = {}
+    if isinstance(response, dict):
+        for obj in response.get('objects', []):
+            created[obj[key]] = obj
+    return created
+
+
+@metrics.timed('create_objects_in_bulk')
+def create_objects_in_bulk(api, tasks):
+    """Create the languages, users and projects missing for the tasks.
+
+    A single request is used for each kind of object. The tasks whose project
+    was created get their 'project_backlink' field set, and the created
+    languages and users are remembered, so the per task stages don't need to
+    create them again.
+    """
+    # Languages.
+    missing = OrderedDict()
+    for provided in tasks:
+        for code, fullname in ((provided['source_code'],
+                                provided['source_name']),
+                               (provided['target_code'],
+                                provided['target_name'])):
+            if (code.lower() not in missing and
+                not get_language_api_uri(api, code)):
+                missing[code.lower()] = {
+                    'code': code,
+                    'fullname': fullname,
+                    'translation_projects': [],
+                }
+
+    if missing:
+        created = create_in_bulk(api.languages, missing.values(), 'code')
+        if created is not None:
+            for language_data in missing.values():
+                code = language_data['code']
+                new_lang = created.get(code, {})
+                resource_uri = (new_lang.get('resource_uri') or
+                                lookup_language_api_uri(api, code))
+                if resource_uri:
+                    languages.add(code, resource_uri)
+            logging.info("Succesfully created languages %s." %
+                         ", ".join(missing))
+
+    # Users.
+    missing = OrderedDict()
+    for provided in tasks:
+        username = provided['assignee_id']
+        if username in missing or username in users:
+            continue
+        if user_exists(api, username):
+            users.add(username)
+        else:
+            missing[username] = {
+                'username': username,
+                'email': username,
+            }
+
+    if missing and create_in_bulk(api.users, missing.values(),
+                                  'username') is not None:
+        for username in missing:
+            users.add(username)
+        logging.info("Succesfully created users %s." % ", ".join(missing))
+
+    # Projects. The tasks whose languages are still missing are left for the
+    # per task stages.
+    projects = OrderedDict()
+    for provided in tasks:
+        if 'project_backlink' in provided:
+            continue
+        source_lang_api_uri = get_language_api_uri(api, provided['source_code'])
+        if source_lang_api_uri and get_language_api_uri(api,
+                                                        provided['target_code']):
+            projects[provided['project_code']] = get_project_data(
+                provided, source_lang_api_uri)
+
+    if projects:
+        created = create_in_bulk(api.projects, projects.values(), 'code')
+        if created is not None:
+            for provided in tasks:
+                code = provided['project_code']
+                if code not in projects:
+                    continue
+                if code in created:
+                    provided['project_backlink'] = created[code]['backlink']
+                else:
+                    provided['project_backlink'] = get_project_backlink(api,
+                                                                        code)
+            logging.info("Succesfully created projects %s." %
+                         ", ".join(projects))
+
+
+def get_project_backlink(api, code):
+    """Return the backlink for the given project using the Pootle API."""
+    # GET query to http://localhost:8000/api/v1/projects/?code__exact=task-1
+    # assuming that the provided code is "task-1".
+    proj_data = api.projects.get(code__exact=code)
+    if proj_data['meta']['total_count'] != 1:
+        logging.error("The project '%s' doesn't exist. Aborting." % code)
+        raise Exception
+    return proj_data['objects'][0]['backlink']
 
 
+@metrics.timed('assign_user_to_project')
 def assign_user_to_project(username, project):
     """Assign permissions to the user with assign_permissions."""
-    cmd_args = [
-        "pootle",
-        "assign_permissions",
-        "--project",
-        project,
-        "--user",
-        username,
-        "--permissions",
-        "view,suggest,translate,overwrite,review,archive",
-    ]
-    subprocess.call(cmd_args)
+    run_management_command("assign_permissions",
+                           "--project", project,
+                           "--user", username,
+                           "--permissions",
+                           "view,suggest,translate,overwrite,review,archive")
     logging.info("Succesfully assigned permissions to the translator.")
 
 
+@metrics.timed('notify_trommons')
 def notify_trommons(task_dir_name, project_backlink, json_filename,
                     trommons_dir):
     """Write the 'meta.json' and translated file so Trommons can get it."""
 
-    # Create a temporary directory.
-    temp_dir = mkdtemp()
-
-    # Create a directory named like the Pootle project (Trommons task) inside
-    # the temporary directory.
-    temp_proj_dir = os.path.join(temp_dir, task_dir_name)
-    os.mkdir(temp_proj_dir)
+    # Create a temporary directory inside the Trommons directory, so it can
+    # be renamed when finished instead of being copied. It is hidden so
+    # Trommons doesn't see it before it is finished.
+    temp_proj_dir = mkdtemp(prefix=".%s." % task_dir_name, dir=trommons_dir)
 
     # Open the destination file inside that directory to write the JSON and
     # notify Trommons that the project has been succesfully added.
@@ -434,11 +1994,262 @@ def notify_trommons(task_dir_name, project_backlink, json_filename,
     # Close the file to actually write the JSON.
     output_json_file.close()
 
-    # Move the task directory to the final destination inside the Trommons
-    # directory.
-    shutil.move(temp_proj_dir, trommons_dir)
+    # mkdtemp() creates the directory only readable by its owner.
+    os.chmod(temp_proj_dir, 0755)
 
-    # Remove the temporary directory since we are already done with it.
-    shutil.rmtree(temp_dir)
+    # Rename the task directory to its final name, which makes it appear at
+    # once with all its contents.
+    task_dir = os.path.join(trommons_dir, task_dir_name)
+    try:
+        os.rename(temp_proj_dir, task_dir)
+    except OSError as e:
+        # Trommons might have been notified just before the import was
+        # interrupted, or the translations exported meanwhile, so add the
+        # data to the JSON already there.
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+        shutil.rmtree(temp_proj_dir)
+        update_json_file(os.path.join(task_dir, json_filename), response_data,
+                         ('completed',))
+        logging.info("Succesfully notified Trommons the success in importing, "
+                     "in the existing task directory.")
+        return
 
     logging.info("Succesfully notified Trommons the success in importing.")
+
+
+def update_json_file(json_path, data, keep=()):
+    """Add the data to the JSON file, replacing it atomically.
+
+    The values already in the file for the keys in keep are not replaced.
+    """
+    try:
+        with open(json_path) as json_file:
+            response_data = json.load(json_file)
+    except (IOError, ValueError):
+        response_data = {}
+
+    for key, value in data.items():
+        if key not in keep or key not in response_data:
+            response_data[key] = value
+
+    temp_path = os.path.join(os.path.dirname(json_path),
+                             ".%s.tmp" % os.path.basename(json_path))
+    with open(temp_path, "w") as output_json_file:
+        json.dump(response_data, output_json_file, indent=4,
+                  separators=(',', ': '))
+    os.rename(temp_path, json_path)
+
+
+def start_exporting_translations(interval):
+    """Export the changed translation files every interval seconds."""
+    def export_periodically():
+        while True:
+            time.sleep(interval)
+            try:
+                export_translations()
+            except Exception:
+                logging.exception("Couldn't export the translations.")
+
+    thread = threading.Thread(target=export_periodically)
+    thread.daemon = True
+    thread.start()
+
+
+@metrics.timed('export_translations')
+def export_translations():
+    """Hand over to Trommons the translation files changed since last time.
+
+    Only the projects with translations changed in Pootle since the last
+    export are looked at, and Pootle writes their translations to the files
+    first. The size and modification time of each of their files are compared
+    with the ones in the state file, and only the files that changed are
+    hashed to find the ones that must be exported. The projects still being
+    imported are left for a later export.
+    """
+    state = load_export_state(EXPORT_STATE_FILE)
+    files_state = state.get('files', {})
+
+    started = time.time()
+    since = state.get('since')
+    if since is None:
+        project_codes = [name for name in os.listdir(settings.PODIRECTORY)
+                         if name.startswith("task-")]
+    else:
+        # Overlap the previous export a bit, so translations saved while it
+        # ran are not missed. The hashes avoid exporting the files twice.
+        project_codes = changed_projects(since - 60)
+    project_codes = sorted(
+        project_code for project_code in project_codes
+        if os.path.isdir(os.path.join(settings.PODIRECTORY, project_code)) and
+        import_finished(project_code))
+
+    exported = 0
+    if project_codes:
+        # Write the translations in Pootle database to the translation files.
+        cmd_args = []
+        for project_code in project_codes:
+            cmd_args.extend(["--project", project_code])
+        run_management_command("sync_stores", *cmd_args)
+
+    for project_code in project_codes:
+        for path in list_project_files(project_code):
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+
+            previous = files_state.get(path)
+            if previous is not None and previous[:2] == [info.st_size,
+                                                         info.st_mtime]:
+                continue
+
+            digest = file_digest(path)
+            if previous is None or previous[2] != digest:
+                try:
+                    export_file(project_code, path)
+                except (IOError, OSError):
+                    logging.exception("Couldn't export '%s'." % path)
+                    continue
+                exported += 1
+            files_state[path] = [info.st_size, info.st_mtime, digest]
+
+    save_export_state(EXPORT_STATE_FILE, {'since': started,
+                                          'files': files_state})
+    metrics.inc('exported_files_total', exported)
+    if exported:
+        logging.info("Succesfully exported %d translation files to Trommons." %
+                     exported)
+
+
+def changed_projects(since):
+    """Return the task projects with translations changed since the time."""
+    setup_django()
+
+    from django.db import connection
+    from django.utils import timezone
+    from pootle_store.models import Unit
+
+    if getattr(settings, 'USE_TZ', False):
+        changed_since = datetime.datetime.utcfromtimestamp(since).replace(
+            tzinfo=timezone.utc)
+    else:
+        # Django sets the local time zone of the process to TIME_ZONE.
+        changed_since = datetime.datetime.fromtimestamp(since)
+
+    code_field = 'store__translation_project__project__code'
+    try:
+        return set(Unit.objects.filter(**{
+            'mtime__gt': changed_since,
+            code_field + '__startswith': "task-",
+        }).values_list(code_field, flat=True).distinct())
+    finally:
+        # Don't keep the database connection open between exports.
+        connection.close()
+
+
+def import_finished(project_code):
+    """Return whether the task of the project was completely imported."""
+    changed_dir_path = os.path.join(POOTLE_DIR, project_code)
+    if os.path.exists(changed_dir_path):
+        return False
+    return journal is None or journal.get(changed_dir_path) is None
+
+
+def list_project_files(project_code):
+    """Return the paths of the translation files in the project."""
+    project_dir = os.path.join(settings.PODIRECTORY, project_code)
+    paths = []
+
+    for language in os.listdir(project_dir):
+        language_dir = os.path.join(project_dir, language)
+        if language.startswith(".") or not os.path.isdir(language_dir):
+            continue
+        for filename in os.listdir(language_dir):
+            path = os.path.join(language_dir, filename)
+            if not filename.startswith(".") and os.path.isfile(path):
+                paths.append(path)
+
+    return paths
+
+
+def load_export_state(state_path):
+    """Return the state of the exported files, or an empty one."""
+    try:
+        with open(state_path) as state_file:
+            return json.load(state_file)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {}
+    except ValueError:
+        logging.warning("The export state file is broken, exporting all the "
+                        "translation files again.")
+        return {}
+
+
+def save_export_state(state_path, state):
+    """Write the state of the exported files, replacing it atomically."""
+    temp_path = "%s.%d.tmp" % (state_path, os.getpid())
+    with open(temp_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.rename(temp_path, state_path)
+
+
+def file_digest(path):
+    """Return the SHA-1 hash of the file contents."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def translation_progress(path):
+    """Return the percentage of translated units in the file, or None.
+
+    The file is read with the Translate Toolkit, which comes with Pootle.
+    """
+    try:
+        from translate.storage import factory
+    except ImportError:
+        return None
+
+    try:
+        store = factory.getobject(path)
+    except Exception:
+        logging.exception("Couldn't read '%s' to get its progress." % path)
+        return None
+
+    units = [unit for unit in store.units if unit.istranslatable()]
+    if not units:
+        return 100
+    translated = sum(1 for unit in units if unit.istranslated())
+    return 100 * translated // len(units)
+
+
+def export_file(project_code, path):
+    """Put the translation file and its progress in the task directory.
+
+    Each file is written with a hidden name and then renamed, so Trommons
+    never sees a half written file. The JSON file goes last.
+    """
+    task_dir = os.path.join(TROMMONS_DIR, project_code)
+    try:
+        os.mkdir(task_dir, 0755)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    filename = os.path.basename(path)
+    temp_path = os.path.join(task_dir, ".%s.tmp" % filename)
+    copy_file(path, temp_path)
+    os.rename(temp_path, os.path.join(task_dir, filename))
+
+    progress = translation_progress(path)
+    update_json_file(os.path.join(task_dir, JSON_FILENAME), {
+        'created': True,
+        'completed': progress == 100,
+        'progress': progress,
+        'translation_filename': filename,
+    })